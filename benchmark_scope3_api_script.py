@@ -0,0 +1,301 @@
+########################################################################################
+# BENCHMARK OF sample_scope3_api_script.py
+########################################################################################
+# THIS SCRIPT MEASURES THE SPEED AND MEMORY USE OF sample_scope3_api_script.py WITHOUT SCOPE3 CREDENTIALS:
+# 1- IT GENERATES SYNTHETIC INPUT FILES SHAPED LIKE sample_input_file.csv (10k, 1M, 10M ROWS BY DEFAULT)
+# 2- IT STARTS A LOCAL MOCK OF THE /v1/calculate/daily?includeRows=true ENDPOINT WITH CONFIGURABLE LATENCY AND ERROR RATE
+# 3- IT RECORDS THE TIME, THROUGHPUT AND MEMORY OF EACH STAGE OF THE SCRIPT (READ, NORMALIZE, PAYLOAD, API CALLS, MERGE, OUTPUTS, REPORTS) FROM ITS RUN METRICS
+# 4- IT WRITES THE RESULTS TO A JSON FILE THAT CAN BE COMPARED WITH A PREVIOUS RUN TO CATCH REGRESSIONS
+#
+# EXAMPLES:
+# python benchmark_scope3_api_script.py --sizes 10000 1000000 --output benchmark_results.json
+# python benchmark_scope3_api_script.py --sizes 10000 --compare benchmark_results.json --min-seconds 1
+# python benchmark_scope3_api_script.py generate --rows 1000000 --output synthetic_input.csv
+# python benchmark_scope3_api_script.py serve --port 8080 --latency 0.2 --error-rate 0.05
+########################################################################################
+
+############################## IMPORT OF MODULES ##############################
+import argparse
+import contextlib
+import datetime
+import gzip
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+import pandas as pd
+
+############################## SYNTHETIC INPUT FILES #########################################
+# Values are picked among the aliases sample_scope3_api_script.py understands, plus a few it doesn't, to exercise every branch of the script.
+channel_aliases = {
+	'web': ['Web', 'web', 'Web optimized for device'],
+	'app': ['App', 'app', 'mobile_app'],
+	'streaming': ['CTV', 'STREAMING', 'streaming-video', 'OTT'],
+}
+device_aliases = ['Smart Phone', 'mobile', 'Mobile', 'phone', 'Tablet', 'tablet', 'Desktop', 'desktop', 'PC', 'ctv', 'SmartTV', 'TV', 'Unknown']
+creative_type_aliases = ['Standard', 'banner', 'Display', 'Publisher hosted', 'video', 'Video', 'Native site', 'text', 'Audio']
+creative_sizes = ['300x250', '728x90', '160x600', '320x50', '300x600', '970x250', 'Unknown']
+countries = ['AU', 'US', 'GB', 'CA', 'FR', 'DE']
+sellers = ['Xandr', 'Magnite', 'PubMatic', 'Index Exchange', None]
+buying_methods = ['programmatic-open', 'programmatic-pmp', 'programmatic-guaranteed', 'direct', 'direct-takeover', 'open auction', None]
+
+def build_domains(number_of_domains, use_alias_variants):
+	# Each domain can appear bare, with www. or as a full URL when use_alias_variants is set, like they do in real delivery logs.
+	domains = []
+	for i in range(number_of_domains):
+		domain = 'site' + str(i) + '.com'
+		domains.append(domain)
+		if use_alias_variants:
+			domains += ['www.' + domain, 'https://www.' + domain + '/section/' + str(i % 7), 'http://' + domain + '/']
+	return domains
+
+def build_apps(number_of_apps, use_alias_variants):
+	# Apps are bundle ids, and store URLs of every store normalizeApp supports when use_alias_variants is set.
+	apps = []
+	for i in range(number_of_apps):
+		apps.append('com.example.app' + str(i))
+		if use_alias_variants:
+			apps += [
+				'https://apps.apple.com/us/app/example-app-' + str(i) + '/id' + str(400000000 + i),
+				'https://play.google.com/store/apps/details?id=com.example.app' + str(i) + '&hl=en',
+				'https://channelstore.roku.com/details/' + str(i) + '/example',
+				'https://www.amazon.com/dp/B0' + str(i).zfill(8),
+			]
+	return apps
+
+def generate_input_file(file_name, rows, number_of_domains=5000, number_of_apps=2000, channel_mix=(0.6, 0.3, 0.1), use_alias_variants=True, seed=0, chunk_rows=1000000):
+	# This function writes a synthetic input file of the given number of rows, chunk_rows rows at a time so that 10M+ row files can be generated with little memory.
+	# channel_mix gives the share of web, app and streaming rows.
+	rng = np.random.default_rng(seed)
+	domains = np.array(build_domains(number_of_domains, use_alias_variants), dtype=object)
+	apps = np.array(build_apps(number_of_apps, use_alias_variants), dtype=object)
+	dates = np.array([(datetime.date(2023, 1, 1) + datetime.timedelta(days=i)).strftime('%d/%m/%Y') for i in range(90)], dtype=object)
+	channel_probabilities = np.array(channel_mix, dtype=float) / sum(channel_mix)
+
+	for start in range(0, rows, chunk_rows):
+		n = min(chunk_rows, rows - start)
+		channels = rng.choice(3, n, p=channel_probabilities)
+		inventory = np.where(channels == 0, rng.choice(domains, n), rng.choice(apps, n))
+		environment = np.empty(n, dtype=object)
+		for channel_number, channel in enumerate(['web', 'app', 'streaming']):
+			mask = channels == channel_number
+			environment[mask] = rng.choice(channel_aliases[channel], int(mask.sum()))
+		chunk_df = pd.DataFrame({
+			'Date': rng.choice(dates, n),
+			'Country': rng.choice(countries, n),
+			'App/URL': inventory,
+			'Device Type': rng.choice(device_aliases, n),
+			'Environment': environment,
+			'Creative Type': rng.choice(creative_type_aliases, n),
+			'Creative Size': rng.choice(creative_sizes, n),
+			'Max Video Duration (seconds)': rng.choice([6, 15, 30], n).astype(float),
+			'Seller': rng.choice(np.array(sellers, dtype=object), n),
+			'Buying Method': rng.choice(np.array(buying_methods, dtype=object), n),
+			'Line Item ID': rng.integers(1, 500, n),
+			'Impressions': rng.integers(1, 5000, n),
+		})
+		chunk_df.to_csv(file_name, index=False, mode='w' if start == 0 else 'a', header=start == 0)
+
+############################## MOCK SCOPE3 API #########################################
+class MockScope3API(BaseHTTPRequestHandler):
+	# This class answers POST /v1/calculate/daily like the Scope3 API does, after latency seconds, and with a 503 for error_rate of the calls.
+	# Emissions are a deterministic function of the row so that results can be compared between runs.
+	protocol_version = "HTTP/1.1"
+	latency = 0.0
+	error_rate = 0.0
+	missing_rate = 0.1
+	# Number of calls being answered, and the most seen at the same time, e.g. to check client-side concurrency limits.
+	calls_in_flight = 0
+	max_calls_in_flight = 0
+	lock = threading.Lock()
+	# (status, headers) pairs answered to the next calls, before going back to normal answers, e.g. [(429, {'Retry-After': '1'}), (503, {})].
+	forced_errors = []
+
+	def log_message(self, format, *args):
+		pass
+
+	def do_POST(self):
+		body = self.rfile.read(int(self.headers['Content-Length']))
+		if self.headers.get('Content-Encoding') == 'gzip':
+			body = gzip.decompress(body)
+		with MockScope3API.lock:
+			MockScope3API.calls_in_flight += 1
+			MockScope3API.max_calls_in_flight = max(MockScope3API.max_calls_in_flight, MockScope3API.calls_in_flight)
+		time.sleep(self.latency)
+		with MockScope3API.lock:
+			MockScope3API.calls_in_flight -= 1
+			forced_error = MockScope3API.forced_errors.pop(0) if MockScope3API.forced_errors else None
+		if forced_error is not None:
+			self.answer(forced_error[0], {'error': 'Forced error'}, forced_error[1])
+		elif not self.path.startswith('/v1/calculate/daily'):
+			self.answer(404, {'error': 'Not found'})
+		elif random.random() < self.error_rate:
+			self.answer(503, {'error': 'Service unavailable'})
+		else:
+			self.answer(200, self.calculate(json.loads(body)['rows']))
+
+	def calculate(self, rows):
+		result_rows = []
+		impressionsModeled = 0
+		impressionsSkipped = 0
+		for row in rows:
+			impressions = row['impressions']
+			if (zlib.crc32(row.get('inventoryId', '').encode()) % 1000) / 1000 < self.missing_rate:
+				result_rows.append({'identifier': row['identifier'], 'domainCoverage': 'missing', 'mediaDistributionEmissions': 0, 'adSelectionEmissions': 0, 'creativeDistributionEmissions': 0})
+				impressionsSkipped += impressions
+				continue
+			size_factor = 1 + row['creative'].get('payloadSize', 0) / 1000000 + row['creative'].get('durationSeconds', 0) / 10
+			result_rows.append({
+				'identifier': row['identifier'],
+				'domainCoverage': 'modeled',
+				'mediaDistributionEmissions': impressions * 0.05 * size_factor,
+				'adSelectionEmissions': impressions * 0.2,
+				'creativeDistributionEmissions': impressions * 0.01 * size_factor,
+			})
+			impressionsModeled += impressions
+		return {'rows': result_rows, 'impressionsModeled': impressionsModeled, 'impressionsSkipped': impressionsSkipped}
+
+	def answer(self, status, response, headers=None):
+		content = json.dumps(response).encode()
+		self.send_response(status)
+		for name, value in (headers or {}).items():
+			self.send_header(name, value)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(content)))
+		self.end_headers()
+		self.wfile.write(content)
+
+def start_mock_api(port=0, latency=0.0, error_rate=0.0):
+	# Starts the mock API in a background thread and returns the server; its url is http://127.0.0.1:<server.server_port>/v1/calculate/daily
+	MockScope3API.latency = latency
+	MockScope3API.error_rate = error_rate
+	MockScope3API.max_calls_in_flight = 0
+	MockScope3API.forced_errors = []
+	server = ThreadingHTTPServer(('127.0.0.1', port), MockScope3API)
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	return server
+
+############################## TIMED RUNS #########################################
+def run_pipeline(input_file, api_url):
+	# This function runs sample_scope3_api_script.py on input_file against api_url and returns the timings of its stages, as recorded by the script's own run metrics.
+	# It is meant to run in its own process (see run_benchmark), so that peak memory is measured for one input size at a time.
+	import sample_scope3_api_script as scope3
+	scope3.csv_file_name = input_file
+	scope3.url = api_url
+	scope3.retry_base_delay_seconds = 0.1
+	with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+		scope3.evaluate_emissions(scope3.prepare_input_file(input_file))
+	summary = scope3.run_metrics.get_summary()
+	return {'rows': summary['stages']['read']['rows'], 'stages': summary['stages'], 'api': summary['api'], 'peak_rss_mb': summary['peak_rss_mb']}
+
+def run_benchmark(sizes, latency, error_rate, number_of_domains, number_of_apps, channel_mix, use_alias_variants, work_directory):
+	# For each size: generates the input file (kept in work_directory for the next runs), then times the pipeline in a separate process against a local mock API.
+	server = start_mock_api(latency=latency, error_rate=error_rate)
+	api_url = 'http://127.0.0.1:' + str(server.server_port) + '/v1/calculate/daily?includeRows=true&previewMethodology=false'
+	runs = []
+	for rows in sizes:
+		input_file = os.path.join(work_directory, 'synthetic_input_' + str(rows) + '_' + str(number_of_domains) + '_' + str(number_of_apps) + ('_aliases' if use_alias_variants else '') + '.csv')
+		if not os.path.exists(input_file):
+			print("Generating " + input_file + "...")
+			generate_input_file(input_file, rows, number_of_domains, number_of_apps, channel_mix, use_alias_variants)
+		print("Running the pipeline on " + str(rows) + " rows...")
+		process = subprocess.run([sys.executable, os.path.abspath(__file__), 'run', '--input', input_file, '--api-url', api_url], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+		if process.returncode != 0:
+			print(process.stderr)
+			raise RuntimeError("The pipeline failed on " + str(rows) + " rows.")
+		run = json.loads(process.stdout.strip().splitlines()[-1])
+		for name, stage in run['stages'].items():
+			print("  " + name.ljust(40) + str(stage['seconds']).rjust(10) + "s " + str(stage['rows_per_second']).rjust(12) + " rows/s " + str(stage['peak_rss_mb']).rjust(10) + " MB peak")
+		runs.append(run)
+	server.shutdown()
+	return {
+		'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+		'python': platform.python_version(),
+		'pandas': pd.__version__,
+		'numpy': np.__version__,
+		'settings': {'latency': latency, 'error_rate': error_rate, 'number_of_domains': number_of_domains, 'number_of_apps': number_of_apps, 'channel_mix': list(channel_mix), 'use_alias_variants': use_alias_variants},
+		'runs': runs,
+	}
+
+def compare_results(results, previous_results, threshold, min_seconds=0.0):
+	# Prints the change of every stage duration against a previous results file and returns the stages that got slower by more than threshold (e.g. 0.2 for 20%).
+	# Stages that took less than min_seconds in both runs are left out, so that a few milliseconds of noise on a short stage aren't reported as a regression.
+	regressions = []
+	previous_runs = {run['rows']: run for run in previous_results['runs']}
+	print("==================")
+	print("COMPARISON WITH PREVIOUS RESULTS (" + previous_results['timestamp'] + "): ")
+	for run in results['runs']:
+		if run['rows'] not in previous_runs:
+			continue
+		for name, stage in run['stages'].items():
+			previous_stage = previous_runs[run['rows']]['stages'].get(name)
+			if not previous_stage or not previous_stage['seconds']:
+				continue
+			if max(stage['seconds'], previous_stage['seconds']) < min_seconds:
+				continue
+			change = stage['seconds'] / previous_stage['seconds'] - 1
+			flag = ''
+			if change > threshold:
+				flag = '  <-- REGRESSION'
+				regressions.append((run['rows'], name, change))
+			print(str(run['rows']).rjust(10) + " rows " + name.ljust(40) + str(previous_stage['seconds']).rjust(10) + "s -> " + str(stage['seconds']).rjust(10) + "s (" + ('+' if change >= 0 else '') + str(round(change * 100, 1)) + "%)" + flag)
+	return regressions
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark of sample_scope3_api_script.py against a local mock of the Scope3 API.")
+	parser.add_argument('command', nargs='?', default='bench', choices=['bench', 'generate', 'serve', 'run'])
+	parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 1000000, 10000000], help="Input sizes (rows) to benchmark.")
+	parser.add_argument('--rows', type=int, default=10000, help="Number of rows to generate (generate command).")
+	parser.add_argument('--domains', type=int, default=5000, help="Number of distinct domains.")
+	parser.add_argument('--apps', type=int, default=2000, help="Number of distinct apps.")
+	parser.add_argument('--channel-mix', type=float, nargs=3, default=[0.6, 0.3, 0.1], metavar=('WEB', 'APP', 'STREAMING'))
+	parser.add_argument('--no-alias-variants', action='store_true', help="Only generate bare domains and bundle ids.")
+	parser.add_argument('--latency', type=float, default=0.05, help="Latency of the mock API, in seconds.")
+	parser.add_argument('--error-rate', type=float, default=0.0, help="Share of mock API calls answered with a 503.")
+	parser.add_argument('--port', type=int, default=8080, help="Port of the mock API (serve command).")
+	parser.add_argument('--work-directory', default=os.path.join(tempfile.gettempdir(), 'scope3_benchmark'), help="Where synthetic input files and outputs are kept.")
+	parser.add_argument('--output', default='benchmark_results.json', help="Results file (bench command) or generated file (generate command).")
+	parser.add_argument('--compare', help="Previous results file to compare with.")
+	parser.add_argument('--regression-threshold', type=float, default=0.2)
+	parser.add_argument('--min-seconds', type=float, default=0.5, help="Stages shorter than this in both runs aren't compared.")
+	parser.add_argument('--input', help=argparse.SUPPRESS)
+	parser.add_argument('--api-url', help=argparse.SUPPRESS)
+	args = parser.parse_args()
+
+	if args.command == 'run':
+		print(json.dumps(run_pipeline(args.input, args.api_url)))
+	elif args.command == 'generate':
+		generate_input_file(args.output, args.rows, args.domains, args.apps, args.channel_mix, not args.no_alias_variants)
+		print("We've created " + args.output + " with " + str(args.rows) + " rows.")
+	elif args.command == 'serve':
+		server = start_mock_api(args.port, args.latency, args.error_rate)
+		print("Mock Scope3 API listening on http://127.0.0.1:" + str(server.server_port) + "/v1/calculate/daily, press Ctrl+C to stop.")
+		try:
+			while True:
+				time.sleep(3600)
+		except KeyboardInterrupt:
+			server.shutdown()
+	else:
+		os.makedirs(args.work_directory, exist_ok=True)
+		results = run_benchmark(args.sizes, args.latency, args.error_rate, args.domains, args.apps, args.channel_mix, not args.no_alias_variants, args.work_directory)
+		regressions = []
+		if args.compare:
+			with open(args.compare) as previous_file:
+				regressions = compare_results(results, json.load(previous_file), args.regression_threshold, args.min_seconds)
+		with open(args.output, 'w') as output_file:
+			json.dump(results, output_file, indent=2)
+		print("We've written the benchmark results to " + args.output)
+		if regressions:
+			sys.exit(1)
+
+if __name__ == "__main__":
+	main()
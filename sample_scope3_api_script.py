@@ -16,8 +16,37 @@ import requests
 import numpy as np
 import pandas as pd
 import json
+import gzip
+import hashlib
+import sqlite3
+import re
+import collections
+import contextlib
+import io
 import datetime
+import os
+import time
+import random
+import sys
+import threading
+import multiprocessing
+import traceback
+import argparse
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, FIRST_EXCEPTION
+try:
+	import orjson # Optional: a faster JSON library, used to encode API requests and decode API responses when it is installed.
+except ImportError:
+	orjson = None
+try:
+	import pyarrow # Optional: only needed when use_parquet_output is set to True.
+	import pyarrow.parquet
+except ImportError:
+	pyarrow = None
+try:
+	import resource # Not available on Windows, where peak memory is left out of the run metrics.
+except ImportError:
+	resource = None
 
 # Note: make sure the above Python modules are installed in the machine/server before running this script.
 pd.set_option('display.max_columns', None)
@@ -84,13 +113,226 @@ use_buyingMethod_column = True #REQUIRED
 buyingMethod_header = 'Buying Method'
 supported_buyingMethods = ["programmatic-open", "programmatic-pmp", "programmatic-guaranteed", "direct", "direct-takeover"]
 
+keep_passthrough_columns = True #Set to False to only load the columns this script needs (faster and lighter on memory), the extra columns will then be left out of the output files.
+
 # Constants: do not modify unless required.
 max_json_rows = 100000
 scope3_api_version = '1' # Leave as is to use v1.1
 preview_methology = 'false'
 url = "https://api.scope3.com/v" + scope3_api_version + "/calculate/daily?includeRows=true&previewMethodology=" + preview_methology
 
+# API dispatch settings: only change these if you know your API rate limit.
+max_concurrent_requests = 4 # Number of batches sent to the API at the same time.
+max_requests_per_second = 0 # Client-side rate limit across all batches, 0 means no limit.
+max_retries = 5 # Number of re-tries for a batch on 429/5xx answers and connection errors.
+retry_base_delay_seconds = 2 # First re-try waits up to this long, then the wait doubles on every re-try.
+retry_max_delay_seconds = 60
+request_timeout_seconds = 300
+use_gzip_requests = False # Set to True to gzip-compress the API request bodies.
+
+# Row collapsing: set to True to send a single API row for input rows that only differ by impressions or by columns the API ignores (e.g. line item or ad group).
+# Emissions returned for each API row are split back onto the input rows in proportion to their impressions.
+use_row_collapsing = False
+
+# Emissions cache: set to True to keep per-impression emissions of every API row in a local SQLite file and only send rows that aren't in it yet.
+# Cached values are scaled by the current impressions, which is useful when re-running the same campaigns with restated impressions or overlapping dates.
+use_emissions_cache = False
+emissions_cache_file = 'scope3_emissions_cache.sqlite'
+emissions_cache_ttl_days = 30 # Cached results older than this are fetched again from the API.
+emissions_cache_max_entries = 5000000 # Oldest results are evicted past this number of cached rows.
+
+# Checkpoints: set to True to save the API response of every batch in checkpoint_directory as soon as it arrives.
+# If a run fails part way through, re-running it with the same input file re-uses the saved batches and only sends the ones that didn't complete.
+# The checkpoints are deleted once a run has written all its outputs.
+use_checkpoints = False
+checkpoint_directory = '' # Leave empty to use a folder named after the input file, e.g. sample_input_scope3_checkpoints.
+
+# Parquet output: set to True to also write the output files as Parquet (requires the pyarrow module), so that they can be read back with typed columns.
+use_parquet_output = False
+
+# Streaming mode: set to True for input files too large to fit in memory.
+# The file is then read, sent to the API and written to the output CSV streaming_chunk_rows rows at a time, so memory use only depends on the chunk size.
+use_streaming_mode = False
+streaming_chunk_rows = 500000
+
+# Normalization cache: domains and store URLs are only normalized once per distinct value.
+normalization_cache_size = 1000000 # Maximum number of normalized domains and apps kept in memory.
+normalization_cache_file = '' # Set to a file name (e.g. 'scope3_normalization_cache.json') to re-use normalized domains and apps across runs.
+
+# Run metrics: wall time, CPU time and memory of every stage, and size, latency, re-tries and HTTP status of every API call are recorded during the run and summarized at the end.
+metrics_file = '' # Set to a file name (e.g. 'scope3_metrics.json') to also save them as JSON, e.g. to track nightly runs.
+show_progress = False # Set to True to print the rows/s and estimated time left of the whole run every time a batch comes back from the API. In streaming mode, the number of rows left is estimated from the share of the input file read so far.
+
 ############################## END OF CONFIG SECTION #########################################
+# The settings above, as they are when the script is loaded. run_job and run_jobs start every input file from them (see apply_config).
+default_config = {name: value for name, value in globals().items() if not name.startswith('_') and isinstance(value, (str, int, float, bool, list))}
+
+def apply_config(config):
+	# This function sets the settings of the CONFIG section for the next run from a dict, e.g. {"csv_file_name": "client_a.csv", "country_header": "Market"}.
+	# Settings missing from config go back to their default, so that a config never leaks into the next file processed by the same process.
+	unknown_settings = set(config) - set(default_config)
+	if unknown_settings:
+		raise ValueError("Unknown config setting(s): " + ", ".join(sorted(unknown_settings)))
+	globals().update(default_config)
+	globals().update(config)
+	if 'url' not in config:
+		# url is derived from the API version and methodology settings, so it follows them unless the config sets it explicitly.
+		globals()['url'] = "https://api.scope3.com/v" + scope3_api_version + "/calculate/daily?includeRows=true&previewMethodology=" + preview_methology
+	normalization_cache.max_size = normalization_cache_size
+
+############################## RUN METRICS #########################################
+def get_memory_usage_mb():
+	# Returns the current and the peak resident memory of the process in MB. Either is None when it can't be read on this platform.
+	current_rss = None
+	try:
+		with open('/proc/self/statm') as statm:
+			current_rss = round(int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024), 1)
+	except (OSError, ValueError, AttributeError):
+		pass
+	peak_rss = None
+	if resource is not None:
+		# ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+		peak_rss = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+	return current_rss, peak_rss
+
+def get_percentiles(values):
+	if len(values) == 0:
+		return None
+	p50, p90, p95, p99 = np.percentile(values, [50, 90, 95, 99])
+	return {'p50': round(p50, 3), 'p90': round(p90, 3), 'p95': round(p95, 3), 'p99': round(p99, 3), 'max': round(max(values), 3)}
+
+class RunMetrics:
+	# This class collects the metrics of a run: wall time, CPU time and memory of every stage, and size, latency, re-tries and HTTP status of every API batch.
+	# Stages can be nested (e.g. normalization inside payload building): the time spent in a nested stage is only counted in that stage, not in the enclosing one.
+	def __init__(self):
+		self.started_at = datetime.datetime.now().isoformat(timespec='seconds')
+		self.start_time = time.perf_counter()
+		self.stages = {}
+		self.batches = []
+		self.call_latencies = []
+		self.http_status_counts = collections.Counter()
+		self.lock = threading.Lock()
+		self.local = threading.local()
+
+	@contextlib.contextmanager
+	def stage(self, name, rows=None):
+		# Times the code run inside the with block. A stage run several times (once per chunk or per report) adds up into a single entry.
+		# The number of rows processed can also be set on the yielded dict once it is known.
+		current_stage = {'rows': rows}
+		nested = self.local.__dict__.setdefault('nested', [])
+		nested.append([0.0, 0.0])
+		start_wall = time.perf_counter()
+		start_cpu = time.process_time()
+		try:
+			yield current_stage
+		finally:
+			seconds = time.perf_counter() - start_wall
+			cpu_seconds = time.process_time() - start_cpu
+			nested_seconds, nested_cpu_seconds = nested.pop()
+			if nested:
+				nested[-1][0] += seconds
+				nested[-1][1] += cpu_seconds
+			current_rss, peak_rss = get_memory_usage_mb()
+			with self.lock:
+				stage = self.stages.setdefault(name, {'calls': 0, 'rows': 0, 'seconds': 0.0, 'cpu_seconds': 0.0, 'rss_mb': None, 'peak_rss_mb': None})
+				stage['calls'] += 1
+				stage['rows'] += current_stage['rows'] or 0
+				stage['seconds'] += seconds - nested_seconds
+				stage['cpu_seconds'] += cpu_seconds - nested_cpu_seconds
+				stage['rss_mb'] = current_rss if stage['rss_mb'] is None or current_rss is None else max(stage['rss_mb'], current_rss)
+				stage['peak_rss_mb'] = peak_rss
+
+	def record_api_call(self, status, latency_seconds=None):
+		# Called for every HTTP call, re-tries included. status is the HTTP status code, or the error name when no answer came back.
+		with self.lock:
+			self.http_status_counts[str(status)] += 1
+			if latency_seconds is not None:
+				self.call_latencies.append(latency_seconds)
+
+	def record_batch(self, batch_number, rows, request_bytes, response_bytes, seconds, retries, source='api'):
+		# Called once per batch. seconds covers the whole batch, re-tries and waits included. source is 'checkpoint' for batches re-used from a previous run.
+		with self.lock:
+			self.batches.append({'batch': batch_number, 'rows': rows, 'request_bytes': request_bytes, 'response_bytes': response_bytes, 'seconds': round(seconds, 3), 'retries': retries, 'source': source})
+
+	def get_summary(self):
+		# Returns the metrics as a dict ready to be saved as JSON.
+		with self.lock:
+			stages = {}
+			for name, stage in self.stages.items():
+				stages[name] = dict(stage, seconds=round(stage['seconds'], 3), cpu_seconds=round(stage['cpu_seconds'], 3), rows_per_second=round(stage['rows'] / stage['seconds']) if stage['rows'] and stage['seconds'] > 0 else None)
+			api_batches = [batch for batch in self.batches if batch['source'] == 'api']
+			api = {
+				'batches': len(api_batches),
+				'batches_from_checkpoints': len(self.batches) - len(api_batches),
+				'calls': sum(self.http_status_counts.values()),
+				'retries': sum(batch['retries'] for batch in api_batches),
+				'rows': sum(batch['rows'] for batch in api_batches),
+				'request_bytes': sum(batch['request_bytes'] for batch in api_batches),
+				'response_bytes': sum(batch['response_bytes'] for batch in api_batches),
+				'call_latency_seconds': get_percentiles(self.call_latencies),
+				'batch_seconds': get_percentiles([batch['seconds'] for batch in api_batches]),
+				'http_status_counts': dict(self.http_status_counts),
+			}
+			return {
+				'input_file': csv_file_name,
+				'started_at': self.started_at,
+				'seconds': round(time.perf_counter() - self.start_time, 3),
+				'peak_rss_mb': get_memory_usage_mb()[1],
+				'stages': stages,
+				'api': api,
+				'batch_details': sorted(self.batches, key=lambda batch: batch['batch']),
+			}
+
+	def report(self, file_name=''):
+		# Prints the time spent in each stage and the API call stats, and saves all the metrics to file_name when it is set.
+		summary = self.get_summary()
+		print("==================")
+		print("RUN METRICS: ")
+		print("Total run time: " + str(summary['seconds']) + "s, peak memory: " + str(summary['peak_rss_mb']) + " MB.")
+		for name, stage in summary['stages'].items():
+			print(name.ljust(40) + str(stage['seconds']).rjust(10) + "s " + str(stage['cpu_seconds']).rjust(10) + "s CPU " + str(stage['rss_mb']).rjust(10) + " MB" + ("" if stage['rows_per_second'] is None else str(stage['rows_per_second']).rjust(12) + " rows/s"))
+		api = summary['api']
+		if api['calls'] != 0:
+			print("API calls: " + str(api['calls']) + " for " + str(api['batches']) + " batches (" + str(api['retries']) + " re-tries), " + str(round(api['request_bytes']/1024)) + " KB sent, " + str(round(api['response_bytes']/1024)) + " KB received.")
+			print("API call latency: " + ", ".join(key + " " + str(value) + "s" for key, value in api['call_latency_seconds'].items()) + ".")
+			print("HTTP status counts: " + ", ".join(status + ": " + str(count) for status, count in sorted(api['http_status_counts'].items())) + ".")
+		if file_name:
+			with open(file_name, 'w') as metrics:
+				json.dump(summary, metrics, indent=2)
+			print("We've saved the run metrics in " + file_name + ".")
+
+class ProgressLine:
+	# This class prints the progress of the rows sent to the API over a whole run, with the throughput so far and the estimated time left, when show_progress is set.
+	# In streaming mode, the rows of the chunks not read yet aren't known: the total is estimated from the rows of the chunks read so far and the share of the input file they cover.
+	def __init__(self):
+		self.total_rows = 0
+		self.share_read = 1.0
+		self.done_rows = 0
+		self.start_time = time.perf_counter()
+		self.lock = threading.Lock()
+
+	def add_rows(self, rows):
+		# Called with the number of rows of each chunk, before they are sent to the API.
+		with self.lock:
+			self.total_rows += rows
+
+	def set_share_read(self, share_read):
+		with self.lock:
+			self.share_read = share_read
+
+	def update(self, rows):
+		if not show_progress:
+			return
+		with self.lock:
+			self.done_rows += rows
+			estimated_total_rows = max(self.done_rows, round(self.total_rows / self.share_read) if self.share_read > 0 else self.total_rows)
+			seconds = time.perf_counter() - self.start_time
+			rows_per_second = self.done_rows / seconds if seconds > 0 else 0
+			eta = (estimated_total_rows - self.done_rows) / rows_per_second if rows_per_second > 0 else 0
+			print("Progress: " + str(self.done_rows) + "/" + ("" if self.share_read >= 1 else "~") + str(estimated_total_rows) + " rows (" + str(round(self.done_rows*100 / estimated_total_rows, 1)) + "%), " + str(round(rows_per_second)) + " rows/s, ETA " + str(datetime.timedelta(seconds=round(eta))) + ".")
+
+run_metrics = RunMetrics()
+
 ############################## READ FILE #########################################
 def isNaN(string):
     return string != string
@@ -105,33 +347,117 @@ def normalizeDomain(url_field):
 	domain = urllib.parse.urlparse(url_to_process).netloc
 	return domain
 
+def getStoreIdAfter(separator):
+	def extract(app_field):
+		return app_field.split(sep=separator)[1]
+	return extract
+
+def getStoreIdFromQuery(parameter):
+	def extract(app_field):
+		parsedURL = urllib.parse.urlparse(app_field)
+		return urllib.parse.parse_qs(parsedURL.query)[parameter][0]
+	return extract
+
+def getAmazonStoreId(app_field):
+	if "/dp/" in app_field:
+		return app_field.split(sep="/dp/")[1]
+	elif "/gp/product/" in app_field:
+		return app_field.split(sep="/gp/product/")[1]
+	return app_field
+
+# Store specific rules used by normalizeApp, in order of precedence: (marker found in the store URL, function returning the storeId).
+store_rules = [
+	("apps.apple.com", getStoreIdAfter("/id")),
+	("play.google.com/store/apps/", getStoreIdFromQuery('id')),
+	("samsung.com/us/appstore/", getStoreIdAfter("/app/")),
+	("amazon.com/", getAmazonStoreId),
+	("lgappstv.com/", getStoreIdFromQuery('appId')),
+	("roku.com/", getStoreIdAfter("/details/")),
+]
+store_rules_pattern = re.compile("|".join(re.escape(marker) for marker, extract in store_rules))
+store_rules_table = {marker: (precedence, extract) for precedence, (marker, extract) in enumerate(store_rules)}
+
 def normalizeApp(app_field):
+	# This function returns the storeId of an app store URL (app_field), or app_field itself if it isn't a supported store URL.
+	# A single regex search finds which store markers are present, and the rule with the highest precedence is applied.
+	markers = store_rules_pattern.findall(app_field)
+	if not markers:
+		return app_field
+	precedence, extract = min(store_rules_table[marker] for marker in markers)
 	try:
-		if "apps.apple.com" in app_field:
-			storeId = app_field.split(sep="/id")[1]
-		elif "play.google.com/store/apps/" in app_field:
-			parsedURL = urllib.parse.urlparse(app_field)
-			storeId = urllib.parse.parse_qs(parsedURL.query)['id'][0]
-		elif "samsung.com/us/appstore/" in app_field:
-			storeId = app_field.split(sep="/app/")[1]
-		elif "amazon.com/" in app_field:
-			if "/dp/" in app_field:
-				storeId = app_field.split(sep="/dp/")[1]
-			elif "/gp/product/" in app_field:
-				storeId = app_field.split(sep="/gp/product/")[1]
-			else:
-				storeId = app_field
-		elif "lgappstv.com/" in app_field:
-			parsedURL = urllib.parse.urlparse(app_field)
-			storeId = urllib.parse.parse_qs(parsedURL.query)['appId'][0]
-		elif "roku.com/" in app_field:
-			storeId = app_field.split(sep="/details/")[1]
-		else:
-			storeId = app_field
-	except IndexError as e:
+		storeId = extract(app_field)
+	except IndexError:
 		storeId = app_field
 	return storeId
 
+class NormalizationCache:
+	# This class is a bounded LRU cache of normalized inventory ids keyed by (normalizer, raw value).
+	# It can be saved to and loaded from a JSON file so it gets re-used across runs.
+	def __init__(self, max_size):
+		self.max_size = max_size
+		self.entries = collections.OrderedDict()
+		# Keys normalized since the last pop_new_entries, only kept in the worker processes of run_jobs (see init_worker). Bounded like the entries.
+		self.track_new_keys = False
+		self.new_keys = collections.OrderedDict()
+		self.hits = 0
+		self.misses = 0
+
+	def normalize(self, kind, raw_value):
+		key = (kind, raw_value)
+		try:
+			value = self.entries[key]
+			self.entries.move_to_end(key)
+			self.hits += 1
+			return value
+		except KeyError:
+			self.misses += 1
+		value = normalizers[kind](raw_value)
+		self.entries[key] = value
+		if len(self.entries) > self.max_size:
+			self.entries.popitem(last=False)
+		if self.track_new_keys:
+			self.new_keys[key] = None
+			if len(self.new_keys) > self.max_size:
+				self.new_keys.popitem(last=False)
+		return value
+
+	def add_entries(self, entries):
+		# entries is an iterable of ((kind, raw_value), value) pairs, e.g. the ones returned by pop_new_entries in another process.
+		for key, value in entries:
+			self.entries[key] = value
+		while len(self.entries) > self.max_size:
+			self.entries.popitem(last=False)
+
+	def pop_new_entries(self):
+		# Returns the entries normalized since the last call, so that they can be shared with other processes.
+		new_entries = [(key, self.entries[key]) for key in self.new_keys if key in self.entries]
+		self.new_keys = collections.OrderedDict()
+		return new_entries
+
+	def load(self, file_name):
+		if not file_name or not os.path.exists(file_name):
+			return
+		with open(file_name) as cache_file:
+			self.add_entries(((kind, raw_value), value) for kind, raw_value, value in json.load(cache_file))
+		print("Loaded " + str(len(self.entries)) + " normalized domains and apps from " + file_name)
+
+	def save(self, file_name):
+		if not file_name:
+			return
+		with open(file_name, 'w') as cache_file:
+			json.dump([[kind, raw_value, value] for (kind, raw_value), value in self.entries.items()], cache_file)
+
+normalizers = {'domain': normalizeDomain, 'app': normalizeApp}
+normalization_cache = NormalizationCache(normalization_cache_size)
+
+def normalize_inventory_column(values, kind):
+	# This function normalizes a column of domains ('domain') or apps ('app').
+	# Each distinct raw value is normalized once, through normalization_cache, and the results are mapped back onto the column.
+	with run_metrics.stage('normalize'):
+		codes, uniques = pd.factorize(values, use_na_sentinel=False)
+		normalized = np.array([normalization_cache.normalize(kind, str(x)) for x in uniques], dtype=object)
+		return pd.Series(normalized[codes], index=values.index, dtype=object)
+
 def normalizeDomainOrApp(row):
 	# This function returns 
 	if row['scope3_formatted_channel'] == 'display-web':
@@ -139,140 +465,771 @@ def normalizeDomainOrApp(row):
 	else:
 		return normalizeApp(row[site_domain_or_app_header])
 
+def get_input_columns():
+	# This function returns the columns of the input file used to build the API rows, and the ones among them worth loading as categoricals.
+	# Low-cardinality columns (and domains/apps, which repeat a lot) are stored once per distinct value instead of once per row.
+	categorical_columns = [site_domain_or_app_header, country_header, device_type_header, creative_format_header]
+	if use_separate_column_for_apps:
+		categorical_columns.append(separate_app_header)
+	if use_date_column:
+		categorical_columns.append(date_header)
+	if use_region_column:
+		categorical_columns.append(region_header)
+	if use_channel_column:
+		categorical_columns.append(channel_header)
+	if use_creative_size_column:
+		categorical_columns.append(creative_size_header)
+	if use_seller_column:
+		categorical_columns.append(seller_header)
+	if use_buyingMethod_column:
+		categorical_columns.append(buyingMethod_header)
+	input_columns = categorical_columns + [impressions_header, creative_duration_header]
+	if use_payloadSize_column:
+		input_columns.append(payloadSize_header)
+	if not use_creative_size_column:
+		input_columns += [creative_width_header, creative_height_header]
+	return input_columns, categorical_columns
+
+def read_input_csv(csv_file, **read_csv_options):
+	input_columns, categorical_columns = get_input_columns()
+	usecols = None if keep_passthrough_columns else (lambda column: column in input_columns)
+	return pd.read_csv(csv_file, sep=csv_separator, on_bad_lines='skip', usecols=usecols, dtype={column: 'category' for column in categorical_columns}, **read_csv_options)
+
 def prepare_input_file(csv_file):
 	# This function creates a dataframe from the input CSV file.
 	# This dataframe has all the columns that will be needed 
 
 	print("Reading input file " + csv_file)
-	report_df = pd.read_csv(csv_file, sep=csv_separator, on_bad_lines='skip')
+	with run_metrics.stage('read') as stage:
+		report_df = read_input_csv(csv_file)
+		stage['rows'] = len(report_df.index)
 	print("Number of valid rows found: " + str(len(report_df.index)) + " rows")
+	with run_metrics.stage('normalize', len(report_df.index)):
+		return format_input_rows(report_df)
+
+def read_input_file_in_chunks(csv_file, progress=None):
+	# This function reads the input CSV file streaming_chunk_rows rows at a time and yields each chunk once it has been formatted.
+	# Row identifiers keep counting across chunks so they stay unique for the whole file.
+	# The share of the file read so far is passed on to progress, so that it can estimate the number of rows left.
+	print("Reading input file " + csv_file + " in chunks of " + str(streaming_chunk_rows) + " rows")
+	first_row_identifier = 0
+	input_file_size = os.path.getsize(csv_file)
+	with open(csv_file, 'rb') as input_file:
+		chunks = read_input_csv(input_file, chunksize=streaming_chunk_rows)
+		while True:
+			with run_metrics.stage('read') as stage:
+				report_df = next(chunks, None)
+				stage['rows'] = 0 if report_df is None else len(report_df.index)
+			if report_df is None:
+				return
+			if progress is not None and input_file_size != 0:
+				progress.set_share_read(input_file.tell() / input_file_size)
+			with run_metrics.stage('normalize', len(report_df.index)):
+				report_df = format_input_rows(report_df, first_row_identifier)
+			yield report_df
+			first_row_identifier += len(report_df.index)
+
+def build_alias_lookup(aliases_by_value):
+	# This function turns lists of aliases into a single dict. When an alias appears in several lists, the first list wins.
+	lookup = {}
+	for value, aliases in aliases_by_value:
+		for alias in aliases:
+			lookup.setdefault(alias, value)
+	return lookup
+
+def map_distinct_values(column, function):
+	# This function applies function once per distinct value of column and maps the results back onto the rows as a categorical.
+	codes, uniques = pd.factorize(column, use_na_sentinel=False)
+	result_codes, results = pd.factorize(pd.Series([function(x) for x in uniques], dtype=object))
+	return pd.Series(pd.Categorical.from_codes(result_codes[codes], results), index=column.index)
+
+def map_distinct_numbers(column, function):
+	# Same as map_distinct_values for functions returning creative dimensions, the result is stored as int32.
+	# The type doesn't depend on the values, so every chunk of a file gets the same columns. Dimensions that don't fit count as 0, like the ones that can't be read.
+	codes, uniques = pd.factorize(column, use_na_sentinel=False)
+	results = np.array([function(x) for x in uniques], dtype='int64')
+	results[(results < np.iinfo('int32').min) | (results > np.iinfo('int32').max)] = 0
+	return pd.Series(results.astype('int32')[codes], index=column.index)
+
+def parseCreativeSize(creative_size):
+	# Returns (width, height) from a creative size like 300x250. Sizes that can't be read count as 0x0.
+	try:
+		width, height = str(creative_size).split('x')
+		return int(width), int(height)
+	except ValueError:
+		return 0, 0
+
+def parseDimension(dimension):
+	return int(dimension) if str(dimension).isdigit() else 0
+
+def format_input_rows(report_df, first_row_identifier=0):
+	# This function adds the scope3_formatted_* columns needed to build the API rows to a dataframe read from the input file.
+	# Dates, aliases and creative sizes are converted once per distinct value, and the new columns are stored as categoricals or compact integers.
 	# Building the three new columns
-	report_df['scope3_row_identifier'] = np.arange(len(report_df))
+	report_df['scope3_row_identifier'] = np.arange(first_row_identifier, first_row_identifier + len(report_df))
+	# Impressions are stored as int32 whatever the values of the chunk, unless one of them doesn't fit (they then stay int64).
+	impressions = report_df[impressions_header]
+	if pd.api.types.is_integer_dtype(impressions) and impressions.between(np.iinfo('int32').min, np.iinfo('int32').max).all():
+		report_df[impressions_header] = impressions.astype('int32')
 
 	if use_date_column:
-		report_df['scope3_formatted_date'] = pd.to_datetime(report_df[date_header],format=date_format).dt.strftime('%Y-%m-%d')
+		report_df['scope3_formatted_date'] = map_distinct_values(report_df[date_header], lambda x: pd.to_datetime(x, format=date_format).strftime('%Y-%m-%d') if not isNaN(x) else np.nan)
 	else:
 		report_df['scope3_formatted_date'] = (datetime.date.today() - datetime.timedelta(days=2)).strftime("%Y-%m-%d")
-	report_df['scope3_formatted_device_type'] = ['phone' if x in phone_aliases else 'tablet' if x in tablet_aliases else 'pc' if x in pc_aliases else 'tv' if x in tv_aliases else 'pc' for x in report_df[device_type_header]]
-	report_df['scope3_formatted_creative_format'] = ['banner' if x in banner_aliases else 'video' if x in video_aliases else 'text' if x in text_aliases else 'unknown' for x in report_df[creative_format_header]]
+	device_types = build_alias_lookup([('phone', phone_aliases), ('tablet', tablet_aliases), ('pc', pc_aliases), ('tv', tv_aliases)])
+	report_df['scope3_formatted_device_type'] = map_distinct_values(report_df[device_type_header], lambda x: device_types.get(x, 'pc'))
+	creative_formats = build_alias_lookup([('banner', banner_aliases), ('video', video_aliases), ('text', text_aliases)])
+	report_df['scope3_formatted_creative_format'] = map_distinct_values(report_df[creative_format_header], lambda x: creative_formats.get(x, 'unknown'))
 	
 	if use_channel_column:
-		report_df['scope3_formatted_channel'] = ['display-web' if x in web_aliases else  'display-app' if x in app_aliases else 'streaming-video' if x in streaming_aliases else '' for x in report_df[channel_header]]
+		channels = build_alias_lookup([('display-web', web_aliases), ('display-app', app_aliases), ('streaming-video', streaming_aliases)])
+		report_df['scope3_formatted_channel'] = map_distinct_values(report_df[channel_header], lambda x: channels.get(x, ''))
 	else:
 		report_df['scope3_formatted_channel'] = ''
 
-	report_df['scope3_formatted_width'] = 0
-	report_df['scope3_formatted_height'] = 0
+	report_df['scope3_formatted_width'] = np.zeros(len(report_df), dtype='int32')
+	report_df['scope3_formatted_height'] = np.zeros(len(report_df), dtype='int32')
 
 	if use_creative_size_column and creative_size_header in report_df:
-		report_df[creative_size_header] = report_df[creative_size_header].replace({'Unknown':'0x0'})
-		report_df[['scope3_formatted_width','scope3_formatted_height']] = report_df[creative_size_header].str.split('x',expand=True)
+		report_df[creative_size_header] = map_distinct_values(report_df[creative_size_header], lambda x: '0x0' if x == 'Unknown' else x)
+		report_df['scope3_formatted_width'] = map_distinct_numbers(report_df[creative_size_header], lambda x: parseCreativeSize(x)[0])
+		report_df['scope3_formatted_height'] = map_distinct_numbers(report_df[creative_size_header], lambda x: parseCreativeSize(x)[1])
 	elif not use_creative_size_column and creative_width_header in report_df and creative_height_header in report_df:
-		report_df.loc[report_df[creative_width_header].astype(str).str.isdigit(), 'scope3_formatted_width'] = report_df[creative_width_header]
-		report_df.loc[report_df[creative_height_header].astype(str).str.isdigit(), 'scope3_formatted_height'] = report_df[creative_height_header]
+		report_df['scope3_formatted_width'] = map_distinct_numbers(report_df[creative_width_header], parseDimension)
+		report_df['scope3_formatted_height'] = map_distinct_numbers(report_df[creative_height_header], parseDimension)
 
 	# Returning the dataframe
 	return(report_df)
 
 
-def evaluate_emissions(report_df):
-	# This function uses the dataframe constructed in the previous function to build JSON objects and make the necessary number of calls to the Scope3 API to obtain emissions data.
-	# Key stats are calculated off the back of this data and displayed on terminal through prints, as well as exported as CSV files.
-	rows_to_compute = []
-
-	for index, row in report_df.iterrows():
-		row_dict = {}
-		row_dict["identifier"] = str(row["scope3_row_identifier"])
-
-		if row["scope3_formatted_channel"] != '':
-			row_dict["channel"] = str(row["scope3_formatted_channel"])
-		if row["scope3_formatted_channel"] in ['display-web']:
-			row_dict["inventoryId"] = normalizeDomain(str(row[site_domain_or_app_header]))
-		elif row["scope3_formatted_channel"] in ['display-app', '', 'streaming-video']:
-			row_dict["inventoryId"] = normalizeApp(str(row[separate_app_header])) if use_separate_column_for_apps else normalizeApp(str(row[site_domain_or_app_header]))
-
-		row_dict["country"] = row[country_header]
-		if use_region_column:
-			row_dict['region'] = str(row[region_header])
-		row_dict["deviceType"] = row["scope3_formatted_device_type"]
-		try:
-			row_dict["impressions"] = int(row[impressions_header])
-		except ValueError:
-			row_dict["impressions"] = 0
-		row_dict["date"] = str(row["scope3_formatted_date"])
-		row_dict["creative"] = {}
-		row_dict["creative"]["format"] = row['scope3_formatted_creative_format']
+def toIntOrZero(value):
+	# This function mirrors the int() cast used for impressions: anything that can't be cast becomes 0.
+	try:
+		return int(value)
+	except ValueError:
+		return 0
 
+def build_payload_columns(report_df):
+	# This function derives every field of the API rows as whole columns instead of looping over the dataframe row by row.
+	# Optional keys (channel, region, seller, buyingMethod) and the creative sub-fields come with a boolean mask telling which rows carry them.
+	# Rows are only turned into dicts later on by build_payload_rows, one batch at a time.
+	channel = report_df['scope3_formatted_channel'].map(str)
+	creative_format = report_df['scope3_formatted_creative_format'].map(str)
+	columns = {}
+	columns['identifier'] = report_df['scope3_row_identifier'].map(str)
+	columns['channel'] = channel
+	columns['channel_mask'] = (channel != '')
 
-		if row["scope3_formatted_creative_format"] == 'video':
-			row_dict["creative"]["durationSeconds"] = int(row[creative_duration_header])
-		elif row["scope3_formatted_creative_format"] == 'banner':
-			if use_payloadSize_column:
-				row_dict["creative"]['payloadSize'] = int(row[payloadSize_header])
-			else:
-				row_dict["creative"]['payloadSize'] = int(int(row['scope3_formatted_width']) * int(row['scope3_formatted_height']) * 1.2)
+	app_column = separate_app_header if use_separate_column_for_apps else site_domain_or_app_header
+	web_mask = (channel == 'display-web')
+	app_mask = channel.isin(['display-app', '', 'streaming-video'])
+	inventoryId = pd.Series('', index=report_df.index, dtype=object)
+	if web_mask.any():
+		inventoryId[web_mask] = normalize_inventory_column(report_df.loc[web_mask, site_domain_or_app_header], 'domain')
+	if app_mask.any():
+		inventoryId[app_mask] = normalize_inventory_column(report_df.loc[app_mask, app_column], 'app')
+	columns['inventoryId'] = inventoryId
+	columns['inventoryId_mask'] = web_mask | app_mask
+
+	columns['country'] = report_df[country_header]
+	if use_region_column:
+		columns['region'] = report_df[region_header].map(str)
+	columns['deviceType'] = report_df['scope3_formatted_device_type']
 
-		if use_seller_column and not isNaN(row[seller_header]):
-			row_dict["seller"] = str(row[seller_header])
+	impressions = report_df[impressions_header]
+	if pd.api.types.is_integer_dtype(impressions) or pd.api.types.is_bool_dtype(impressions):
+		columns['impressions'] = impressions.astype('int64')
+	else:
+		# Casting each distinct value once keeps the exact int() semantics (e.g. '1,000' or NaN become 0).
+		codes, uniques = pd.factorize(impressions, use_na_sentinel=False)
+		columns['impressions'] = pd.Series(np.array([toIntOrZero(x) for x in uniques], dtype='int64')[codes], index=report_df.index)
+	columns['date'] = report_df['scope3_formatted_date'].map(str)
+	columns['format'] = creative_format
 
-		if use_buyingMethod_column and row[buyingMethod_header] in supported_buyingMethods :
-			row_dict["buyingMethod"] = row[buyingMethod_header]
+	video_mask = (creative_format == 'video')
+	banner_mask = (creative_format == 'banner')
+	durationSeconds = pd.Series(0, index=report_df.index, dtype='int64')
+	if video_mask.any():
+		durationSeconds[video_mask] = report_df.loc[video_mask, creative_duration_header].astype('int64')
+	payloadSize = pd.Series(0, index=report_df.index, dtype='int64')
+	if banner_mask.any():
+		if use_payloadSize_column:
+			payloadSize[banner_mask] = report_df.loc[banner_mask, payloadSize_header].astype('int64')
+		else:
+			width = report_df.loc[banner_mask, 'scope3_formatted_width'].astype('int64')
+			height = report_df.loc[banner_mask, 'scope3_formatted_height'].astype('int64')
+			payloadSize[banner_mask] = (width * height * 1.2).astype('int64')
+	columns['durationSeconds'] = durationSeconds
+	columns['durationSeconds_mask'] = video_mask
+	columns['payloadSize'] = payloadSize
+	columns['payloadSize_mask'] = banner_mask
 
-		rows_to_compute.append(row_dict)
+	if use_seller_column:
+		columns['seller'] = report_df[seller_header].map(str)
+		columns['seller_mask'] = report_df[seller_header].notna()
+	if use_buyingMethod_column:
+		columns['buyingMethod'] = report_df[buyingMethod_header]
+		columns['buyingMethod_mask'] = report_df[buyingMethod_header].isin(supported_buyingMethods)
 
-	number_of_api_calls_to_make = len(rows_to_compute) // max_json_rows + 1
-	print("Given the size of your input dataset the script will need to go through " + str(number_of_api_calls_to_make) + " loop(s) to fetch Scope3 emissions data.")
+	return columns
+
+def build_payload_rows(payload_columns, start=0, stop=None):
+	# This function serializes the rows [start:stop] of the payload columns into the list of dicts expected by the Scope3 API.
+	# The output is identical to building each row by hand: same keys, same key order, same conditional keys.
+	def values(name):
+		return payload_columns[name].iloc[start:stop].tolist()
+
+	identifiers = values('identifier')
+	channels, channel_masks = values('channel'), values('channel_mask')
+	inventoryIds, inventoryId_masks = values('inventoryId'), values('inventoryId_mask')
+	countries = values('country')
+	regions = values('region') if 'region' in payload_columns else None
+	deviceTypes = values('deviceType')
+	impressions = values('impressions')
+	dates = values('date')
+	formats = values('format')
+	durations, duration_masks = values('durationSeconds'), values('durationSeconds_mask')
+	payloadSizes, payloadSize_masks = values('payloadSize'), values('payloadSize_mask')
+	sellers, seller_masks = (values('seller'), values('seller_mask')) if 'seller' in payload_columns else (None, None)
+	buyingMethods, buyingMethod_masks = (values('buyingMethod'), values('buyingMethod_mask')) if 'buyingMethod' in payload_columns else (None, None)
+
+	rows = []
+	for j in range(len(identifiers)):
+		row_dict = {"identifier": identifiers[j]}
+		if channel_masks[j]:
+			row_dict["channel"] = channels[j]
+		if inventoryId_masks[j]:
+			row_dict["inventoryId"] = inventoryIds[j]
+		row_dict["country"] = countries[j]
+		if regions is not None:
+			row_dict["region"] = regions[j]
+		row_dict["deviceType"] = deviceTypes[j]
+		row_dict["impressions"] = impressions[j]
+		row_dict["date"] = dates[j]
+		creative = {"format": formats[j]}
+		if duration_masks[j]:
+			creative["durationSeconds"] = durations[j]
+		elif payloadSize_masks[j]:
+			creative["payloadSize"] = payloadSizes[j]
+		row_dict["creative"] = creative
+		if sellers is not None and seller_masks[j]:
+			row_dict["seller"] = sellers[j]
+		if buyingMethods is not None and buyingMethod_masks[j]:
+			row_dict["buyingMethod"] = buyingMethods[j]
+		rows.append(row_dict)
+	return rows
+
+api_result_columns = ['identifier', 'domainCoverage', 'mediaDistributionEmissions', 'adSelectionEmissions', 'creativeDistributionEmissions']
+
+def decode_json(content):
+	return orjson.loads(content) if orjson is not None else json.loads(content)
+
+def encode_json(value):
+	return orjson.dumps(value) if orjson is not None else json.dumps(value, separators=(',', ':'), allow_nan=False).encode()
+
+def encode_request_body(report_json, rows_per_write=10000):
+	# This function encodes the API request body and returns it as bytes, gzip-compressed if use_gzip_requests is set.
+	# Rows are encoded and written to the stream rows_per_write rows at a time. With use_gzip_requests, only the compressed body is kept, as the uncompressed JSON never exists in full.
+	# Without it, the whole uncompressed body is held in the BytesIO, and getvalue() copies it once more into the bytes that are returned.
+	body = io.BytesIO()
+	stream = gzip.GzipFile(fileobj=body, mode='wb', mtime=0) if use_gzip_requests else body
+	rows = report_json["rows"]
+	stream.write(b'{"rows":[')
+	for start in range(0, len(rows), rows_per_write):
+		if start != 0:
+			stream.write(b',')
+		stream.write(encode_json(rows[start:start+rows_per_write])[1:-1])
+	stream.write(b']}')
+	if use_gzip_requests:
+		stream.close()
+	return body.getvalue()
 
-	headers = {
+def get_result_columns(rows):
+	# This function turns the rows of an API response into one list per result column.
+	return {column: [row.get(column) for row in rows] for column in api_result_columns}
+
+class RateLimiter:
+	# This class spaces out API calls so that no more than max_requests_per_second calls are started, whatever the number of threads.
+	# When shared_next_slot is given (a multiprocessing.Value, see run_jobs), the limit applies to all the processes sharing it instead of to this process only.
+	def __init__(self, requests_per_second, shared_next_slot=None):
+		self.interval = 1.0 / requests_per_second if requests_per_second > 0 else 0
+		self.shared_next_slot = shared_next_slot
+		self.next_slot = time.monotonic()
+		self.lock = threading.Lock() if shared_next_slot is None else shared_next_slot.get_lock()
+
+	def wait(self):
+		if self.interval == 0:
+			return
+		with self.lock:
+			now = time.monotonic()
+			if self.shared_next_slot is None:
+				slot = max(now, self.next_slot)
+				self.next_slot = slot + self.interval
+			else:
+				slot = max(now, self.shared_next_slot.value)
+				self.shared_next_slot.value = slot + self.interval
+		if slot > now:
+			time.sleep(slot - now)
+
+# Set in the worker processes of run_jobs (see init_worker), so that the client-side rate limit and the number of concurrent requests apply to all the workers together.
+shared_next_request_slot = None
+shared_request_slots = None
+
+def get_api_headers():
+	return {
 	    "Accept": "application/json",
 	    "Content-Type": "application/json",
 	    "AccessClientId": AccessClientId,
 	    "AccessClientSecret": AccessClientSecret
 	}
 
-	api_result_df = pd.DataFrame()
+def create_api_session():
+	# This function creates a requests session whose connection pool is large enough for all the batches in flight, so connections get re-used between calls.
+	session = requests.Session()
+	adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(1, max_concurrent_requests))
+	session.mount("https://", adapter)
+	session.mount("http://", adapter)
+	session.headers.update(get_api_headers())
+	return session
+
+api_sessions = {}
+
+def get_api_session():
+	# The session, and so its pool of connections to the API, is kept for the whole process: it is re-used by every chunk in streaming mode and by every file a worker processes with run_jobs.
+	# Headers are refreshed on every call as each file can come with its own credentials.
+	pool_size = max(1, max_concurrent_requests)
+	if pool_size not in api_sessions:
+		api_sessions[pool_size] = create_api_session()
+	session = api_sessions[pool_size]
+	session.headers.update(get_api_headers())
+	return session
+
+def get_retry_delay(attempt, retry_after=None):
+	# Exponential backoff with full jitter. A Retry-After header sent by the API takes precedence when it is a number of seconds.
+	if retry_after is not None:
+		try:
+			return min(float(retry_after), retry_max_delay_seconds)
+		except ValueError:
+			pass
+	return random.uniform(0, min(retry_max_delay_seconds, retry_base_delay_seconds * 2 ** attempt))
+
+def post_batch(session, rate_limiter, request_body, batch_number):
+	# This function sends one encoded batch to the API and returns the parsed response.
+	# 429s, 5xx, connection errors and unreadable answers are re-tried up to max_retries times; other errors are raised straight away.
+	attempt = 0
+	while True:
+		rate_limiter.wait()
+		retry_after = None
+		try:
+			with shared_request_slots if shared_request_slots is not None else contextlib.nullcontext():
+				start_time = time.perf_counter()
+				try:
+					req = session.post(url, data=request_body, headers={"Content-Encoding": "gzip"} if use_gzip_requests else None, timeout=request_timeout_seconds)
+				except requests.exceptions.RequestException as error:
+					run_metrics.record_api_call(type(error).__name__)
+					raise
+				run_metrics.record_api_call(req.status_code, time.perf_counter() - start_time)
+			if req.status_code == 429 or req.status_code >= 500:
+				retry_after = req.headers.get("Retry-After")
+				raise requests.exceptions.HTTPError("HTTP " + str(req.status_code) + " answered for batch " + str(batch_number), response=req)
+			req.raise_for_status()
+			response = decode_json(req.content)
+			if 'rows' not in response:
+				raise KeyError('rows')
+			response['response_bytes'] = len(req.content)
+			response['retries'] = attempt
+			return response
+		except requests.exceptions.HTTPError as error:
+			if error.response is not None and error.response.status_code != 429 and error.response.status_code < 500:
+				print("Batch " + str(batch_number) + " was rejected by the API: " + error.response.text)
+				raise
+			last_error = error
+		except (KeyError, requests.exceptions.ConnectionError, requests.exceptions.Timeout, json.decoder.JSONDecodeError) as error:
+			last_error = error
+		if attempt >= max_retries:
+			print("Batch " + str(batch_number) + " failed after " + str(max_retries) + " re-tries.")
+			raise last_error
+		delay = get_retry_delay(attempt, retry_after)
+		print("An error occured on batch " + str(batch_number) + ": " + repr(last_error) + ". Waiting " + str(round(delay, 1)) + "s before re-try " + str(attempt + 1) + " of " + str(max_retries) + ".")
+		time.sleep(delay)
+		attempt += 1
+
+def get_checkpoint_directory():
+	return checkpoint_directory if checkpoint_directory else csv_file_name[:-4] + '_scope3_checkpoints'
+
+def get_checkpoint_file(request_body):
+	# Checkpoints are named after a hash of the API url and of the batch sent, so a batch is only re-used when exactly the same rows are sent to the same endpoint.
+	batch_hash = hashlib.sha1(url.encode() + request_body).hexdigest()
+	return os.path.join(get_checkpoint_directory(), 'batch_' + batch_hash + '.json')
+
+def save_checkpoint(checkpoint_file, response):
+	# The response is written to a temporary file first and then renamed, so an interrupted run never leaves a truncated checkpoint behind.
+	checkpoint = {'rows': response['rows'], 'impressionsModeled': response['impressionsModeled'], 'impressionsSkipped': response['impressionsSkipped']}
+	with open(checkpoint_file + '.tmp', 'wb') as checkpoint_tmp:
+		checkpoint_tmp.write(encode_json(checkpoint))
+	os.replace(checkpoint_file + '.tmp', checkpoint_file)
+
+def remove_checkpoints():
+	# Called once the outputs are written: the checkpoints of a run that completed are deleted, so that running the same file again calls the API instead of re-using old results.
+	# Only the checkpoint files are removed, and the folder itself only if nothing else is left in it.
+	checkpoint_folder = get_checkpoint_directory()
+	if not os.path.isdir(checkpoint_folder):
+		return
+	for file_name in os.listdir(checkpoint_folder):
+		if file_name.startswith('batch_') and (file_name.endswith('.json') or file_name.endswith('.json.tmp')):
+			os.remove(os.path.join(checkpoint_folder, file_name))
+	if not os.listdir(checkpoint_folder):
+		os.rmdir(checkpoint_folder)
+
+def dispatch_batches(payload_columns, number_of_rows, progress=None):
+	# This function splits the payload into batches of max_json_rows rows and sends up to max_concurrent_requests of them at the same time over a pooled session.
+	# progress is the progress line of the whole run, a new one is used when it isn't given.
+	# The responses are returned in batch order, so the result rows come back in the same order as the identifiers.
+	number_of_api_calls_to_make = -(-number_of_rows // max_json_rows)
+	if number_of_api_calls_to_make == 0:
+		return []
+	print("Given the size of your input dataset the script will need to go through " + str(number_of_api_calls_to_make) + " loop(s) to fetch Scope3 emissions data.")
+	rate_limiter = RateLimiter(max_requests_per_second, shared_next_request_slot)
+
+	if use_checkpoints:
+		os.makedirs(get_checkpoint_directory(), exist_ok=True)
+
+	if progress is None:
+		progress = ProgressLine()
+	progress.add_rows(number_of_rows)
+
+	def run_batch(session, i):
+		# Each batch is returned with its result rows already split into columns, so the row dicts of the response can be freed straight away.
+		start_time = time.perf_counter()
+		report_json = {}
+		report_json["rows"] = build_payload_rows(payload_columns, i*max_json_rows, (i+1)*max_json_rows)
+		number_of_batch_rows = len(report_json["rows"])
+		request_body = encode_request_body(report_json)
+		if use_checkpoints:
+			checkpoint_file = get_checkpoint_file(request_body)
+			if os.path.exists(checkpoint_file):
+				print("Loop number " + str(i+1) + " was completed by a previous run, re-using its results from " + checkpoint_file)
+				with open(checkpoint_file, 'rb') as checkpoint:
+					checkpoint_content = checkpoint.read()
+				response = decode_json(checkpoint_content)
+				response['columns'] = get_result_columns(response.pop('rows'))
+				run_metrics.record_batch(i+1, number_of_batch_rows, len(request_body), len(checkpoint_content), time.perf_counter() - start_time, 0, 'checkpoint')
+				progress.update(number_of_batch_rows)
+				return response
+		print("Going through loop number " + str(i+1) + ": sending " + str(number_of_batch_rows) + " rows (" + str(round(len(request_body)/1024)) + " KB)...")
+		#print(report_json) #If the script errors we recommend uncommenting this print and checking that the API input is valid.
+		response = post_batch(session, rate_limiter, request_body, i+1)
+		if use_checkpoints:
+			save_checkpoint(checkpoint_file, response)
+		response['columns'] = get_result_columns(response.pop('rows'))
+		run_metrics.record_batch(i+1, number_of_batch_rows, len(request_body), response.pop('response_bytes'), time.perf_counter() - start_time, response.pop('retries'))
+		progress.update(number_of_batch_rows)
+		return response
+
+	session = get_api_session()
+	with ThreadPoolExecutor(max_workers=max(1, max_concurrent_requests)) as executor:
+		futures = [executor.submit(run_batch, session, i) for i in range(number_of_api_calls_to_make)]
+		# As soon as a batch fails, the batches that haven't started yet are cancelled instead of being sent for nothing. The ones in flight are left to finish.
+		done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+		for future in not_done:
+			future.cancel()
+	for future in futures:
+		if not future.cancelled() and future.exception() is not None:
+			raise future.exception()
+	return [future.result() for future in futures]
+
+def collapse_payload_columns(payload_columns):
+	# This function groups the rows that would send exactly the same payload to the API apart from identifier and impressions.
+	# It returns payload columns with one row per group, whose identifier is the group number and whose impressions are summed, along with the group number of every input row.
+	key_columns = {}
+	for name, column in payload_columns.items():
+		if name in ['identifier', 'impressions'] or name.endswith('_mask'):
+			continue
+		# Values of keys that aren't sent for a row are blanked out so they don't split groups.
+		key_columns[name] = column.where(payload_columns[name + '_mask']) if name + '_mask' in payload_columns else column
+	group_codes = pd.DataFrame(key_columns).groupby(list(key_columns), dropna=False, sort=False, observed=True).ngroup().to_numpy()
+	group_numbers, first_rows = np.unique(group_codes, return_index=True)
+
+	collapsed_columns = {name: column.iloc[first_rows].reset_index(drop=True) for name, column in payload_columns.items()}
+	collapsed_columns['identifier'] = pd.Series(group_numbers).map(str)
+	collapsed_columns['impressions'] = payload_columns['impressions'].groupby(group_codes).sum().reset_index(drop=True)
+	print("Collapsed " + str(len(group_codes)) + " rows into " + str(len(first_rows)) + " API rows.")
+	return collapsed_columns, group_codes
+
+def fan_out_emissions(api_result_df, row_payload_columns, collapsed_columns, group_codes):
+	# This function splits the emissions returned for each collapsed row back onto the input rows of its group, in proportion to their impressions.
+	# Groups without any impressions are split evenly between their rows.
+	emissions_columns = ['mediaDistributionEmissions', 'adSelectionEmissions', 'creativeDistributionEmissions']
+	group_result_df = api_result_df.set_index(api_result_df['identifier'].astype('int64')).reindex(np.arange(len(collapsed_columns['identifier'].index)))
+	row_impressions = row_payload_columns['impressions'].to_numpy()
+	group_impressions = collapsed_columns['impressions'].to_numpy()[group_codes]
+	group_sizes = np.bincount(group_codes)[group_codes]
+	with np.errstate(divide='ignore', invalid='ignore'):
+		shares = np.where(group_impressions != 0, row_impressions / group_impressions, 1.0 / group_sizes)
+
+	fanned_out_df = pd.DataFrame({'identifier': row_payload_columns['identifier'].astype('int64').to_numpy()})
+	fanned_out_df['domainCoverage'] = group_result_df['domainCoverage'].to_numpy()[group_codes]
+	for column in emissions_columns:
+		fanned_out_df[column] = group_result_df[column].to_numpy()[group_codes] * shares
+	return fanned_out_df
+
+class EmissionsCache:
+	# This class stores per-impression emissions of API rows in a SQLite file, keyed by the signature of the row sent to the API.
+	# Entries expire after emissions_cache_ttl_days and the oldest ones are evicted past emissions_cache_max_entries.
+	def __init__(self, file_name, ttl_days, max_entries):
+		self.ttl_seconds = ttl_days * 86400
+		self.max_entries = max_entries
+		self.hits = 0
+		self.misses = 0
+		# Workers of run_jobs can share the same cache file: the timeout lets a worker wait for another one's write to finish.
+		self.connection = sqlite3.connect(file_name, timeout=60)
+		self.connection.execute("CREATE TABLE IF NOT EXISTS emissions (signature TEXT PRIMARY KEY, domainCoverage TEXT, mediaDistributionEmissions REAL, adSelectionEmissions REAL, creativeDistributionEmissions REAL, created_at REAL)")
+		self.connection.execute("CREATE INDEX IF NOT EXISTS emissions_created_at ON emissions (created_at)")
+		self.evict()
+
+	def evict(self):
+		with self.connection:
+			self.connection.execute("DELETE FROM emissions WHERE created_at < ?", (time.time() - self.ttl_seconds,))
+			number_of_entries = self.connection.execute("SELECT COUNT(*) FROM emissions").fetchone()[0]
+			if number_of_entries > self.max_entries:
+				self.connection.execute("DELETE FROM emissions WHERE signature IN (SELECT signature FROM emissions ORDER BY created_at LIMIT ?)", (number_of_entries - self.max_entries,))
+
+	def lookup(self, signatures):
+		# Returns a dataframe indexed by signature with the per-impression emissions of the signatures found in the cache. signatures are expected to be distinct.
+		distinct_signatures = list(signatures)
+		found = []
+		for i in range(0, len(distinct_signatures), 500):
+			batch = distinct_signatures[i:i+500]
+			found += self.connection.execute("SELECT signature, domainCoverage, mediaDistributionEmissions, adSelectionEmissions, creativeDistributionEmissions FROM emissions WHERE created_at >= ? AND signature IN (" + ",".join("?" * len(batch)) + ")", [time.time() - self.ttl_seconds] + batch).fetchall()
+		cached_df = pd.DataFrame(found, columns=['signature', 'domainCoverage', 'mediaDistributionEmissions', 'adSelectionEmissions', 'creativeDistributionEmissions']).set_index('signature')
+		return cached_df.astype({'mediaDistributionEmissions': 'float64', 'adSelectionEmissions': 'float64', 'creativeDistributionEmissions': 'float64'})
+
+	def store(self, per_impression_df):
+		with self.connection:
+			self.connection.executemany("INSERT OR REPLACE INTO emissions VALUES (?, ?, ?, ?, ?, ?)", [row + (time.time(),) for row in per_impression_df.itertuples(index=False, name=None)])
+		self.evict()
+
+emissions_cache = None
+
+def get_emissions_cache():
+	global emissions_cache
+	if emissions_cache is None:
+		emissions_cache = EmissionsCache(emissions_cache_file, emissions_cache_ttl_days, emissions_cache_max_entries)
+	return emissions_cache
+
+def get_row_signatures(payload_columns):
+	# This function returns the cache key of every payload row: all the fields sent to the API except identifier and impressions, plus the API url, version and methodology.
+	# Rows are hashed column by column into two 64-bit hashes (fields that aren't sent for a row hash as 0), seeded with the url, version and methodology, instead of being serialized one by one.
+	# Only the distinct keys are turned into strings: the result is a categorical, so each row only costs a code on top of its distinct key.
+	key_names = [name for name in payload_columns if name not in ['identifier', 'impressions'] and not name.endswith('_mask')]
+	context = hashlib.sha1(json.dumps([key_names, url, scope3_api_version, preview_methology]).encode()).hexdigest()
+	row_hashes = []
+	for seed, hash_key, multiplier in [(context[:16], '0123456789123456', 1000003), (context[16:32], 'scope3_signature', 998244353)]:
+		row_hash = np.full(len(payload_columns['identifier'].index), int(seed, 16), dtype='uint64')
+		for name in key_names:
+			column_hash = pd.util.hash_pandas_object(payload_columns[name], index=False, hash_key=hash_key).to_numpy()
+			if name + '_mask' in payload_columns:
+				column_hash = np.where(payload_columns[name + '_mask'].to_numpy(), column_hash, np.uint64(0))
+			row_hash = row_hash * np.uint64(multiplier) ^ column_hash
+		row_hashes.append(row_hash)
+	codes = pd.DataFrame({'first': row_hashes[0], 'second': row_hashes[1]}).groupby(['first', 'second'], sort=False).ngroup().to_numpy()
+	first_rows = np.unique(codes, return_index=True)[1]
+	distinct_hashes = np.empty((len(first_rows), 2), dtype='>u8')
+	distinct_hashes[:, 0] = row_hashes[0][first_rows]
+	distinct_hashes[:, 1] = row_hashes[1][first_rows]
+	raw_hashes = distinct_hashes.tobytes()
+	distinct_signatures = pd.Index([raw_hashes[i:i+16].hex() for i in range(0, len(raw_hashes), 16)], dtype=object)
+	return pd.Series(pd.Categorical.from_codes(codes, distinct_signatures), index=payload_columns['identifier'].index)
+
+def fetch_cached_emissions(payload_columns):
+	# This function looks the payload rows up in the emissions cache.
+	# It returns the result rows of the cache hits, scaled by their current impressions, and the payload columns of the misses that still need to be sent to the API.
+	# Cache hits count as modeled impressions when their domain was modeled and as skipped impressions otherwise.
+	cache = get_emissions_cache()
+	signatures = get_row_signatures(payload_columns)
+	# Only the distinct signatures are looked up, the rows then pick their cached results through their categorical codes.
+	cached_df = cache.lookup(signatures.cat.categories.tolist()).reindex(signatures.cat.categories)
+	codes = signatures.cat.codes.to_numpy()
+	hit_mask = pd.Series(cached_df['domainCoverage'].notna().to_numpy()[codes], index=signatures.index)
+	cache.hits += int(hit_mask.sum())
+	cache.misses += int((~hit_mask).sum())
+
+	hits_df = cached_df.iloc[codes[hit_mask.to_numpy()]].reset_index(drop=True)
+	impressions = payload_columns['impressions'][hit_mask].to_numpy()
+	for column in ['mediaDistributionEmissions', 'adSelectionEmissions', 'creativeDistributionEmissions']:
+		hits_df[column] = hits_df[column] * impressions
+	hits_df.insert(0, 'identifier', payload_columns['identifier'][hit_mask].astype('int64').to_numpy())
+	modeled_mask = (hits_df['domainCoverage'] == 'modeled').to_numpy()
+	impressionsModeled = int(impressions[modeled_mask].sum())
+	impressionsSkipped = int(impressions[~modeled_mask].sum())
+
+	missed_columns = {name: column[~hit_mask].reset_index(drop=True) for name, column in payload_columns.items()}
+	missed_signatures = signatures[~hit_mask].reset_index(drop=True)
+	return hits_df, impressionsModeled, impressionsSkipped, missed_columns, missed_signatures
+
+def store_cached_emissions(api_result_df, payload_columns, signatures):
+	# This function saves the per-impression emissions of the rows fetched from the API in the emissions cache. Rows without impressions are skipped.
+	rows_df = pd.DataFrame({'signature': signatures, 'identifier': payload_columns['identifier'].astype('int64'), 'impressions': payload_columns['impressions']})
+	rows_df = rows_df[rows_df['impressions'] > 0].merge(api_result_df, on='identifier')
+	per_impression_df = rows_df[['signature', 'domainCoverage']].copy()
+	for column in ['mediaDistributionEmissions', 'adSelectionEmissions', 'creativeDistributionEmissions']:
+		per_impression_df[column] = rows_df[column] / rows_df['impressions']
+	get_emissions_cache().store(per_impression_df.drop_duplicates('signature'))
+
+def fetch_emissions(report_df, progress=None):
+	# This function builds the API rows for the dataframe and fetches their emissions from the Scope3 API, reporting the rows sent to progress when it is given.
+	# It returns one result row per identifier along with the impressionsModeled and impressionsSkipped counters.
+	with run_metrics.stage('payload', len(report_df.index)):
+		payload_columns = build_payload_columns(report_df)
+		if use_row_collapsing:
+			row_payload_columns = payload_columns
+			payload_columns, group_codes = collapse_payload_columns(payload_columns)
+	api_payload_columns = payload_columns
+
+	result_columns = {column: [] for column in api_result_columns}
 	impressionsModeled = 0
 	impressionsSkipped = 0
+	if use_emissions_cache:
+		with run_metrics.stage('emissions_cache', len(payload_columns['identifier'].index)):
+			cached_result_df, impressionsModeled, impressionsSkipped, api_payload_columns, signatures = fetch_cached_emissions(payload_columns)
+	number_of_rows_to_compute = len(api_payload_columns['identifier'].index)
 
-	for i in range(number_of_api_calls_to_make):
-		print("Going through loop number " + str(i+1) + "...")
-		report_json = {}
-		report_json["rows"] = rows_to_compute[i*max_json_rows:(i+1)*max_json_rows-1]
-		print(report_json) #If the script errors we recommend uncommenting this print and checking that the API input is valid.
-		try:
-			req = requests.post(url, json=report_json, headers=headers)
-			response = req.json()
-			response_rows_json_string = json.dumps(response['rows'])
-		except (KeyError, requests.exceptions.ConnectionError, json.decoder.JSONDecodeError) as error:
-			print("An error occured... First printing it...")
-			print(error)
-			print("Now waiting 2s and doing one re-try")
-			time.sleep(2)
-			req = requests.post(url, json=report_json, headers=headers)
-			response = req.json()
-			response_rows_json_string = json.dumps(response['rows'])
-		impressionsModeled += response['impressionsModeled']
-		impressionsSkipped += response['impressionsSkipped']
-		result_df = pd.read_json(response_rows_json_string)
-		api_result_df = pd.concat([api_result_df, result_df],axis=0)
+	with run_metrics.stage('api_calls', number_of_rows_to_compute):
+		for response in dispatch_batches(api_payload_columns, number_of_rows_to_compute, progress):
+			impressionsModeled += response['impressionsModeled']
+			impressionsSkipped += response['impressionsSkipped']
+			for column in api_result_columns:
+				result_columns[column] += response['columns'][column]
+		# The result columns of all batches are only turned into a dataframe once, at the end.
+		api_result_df = pd.DataFrame(result_columns).astype({'identifier': 'int64', 'mediaDistributionEmissions': 'float64', 'adSelectionEmissions': 'float64', 'creativeDistributionEmissions': 'float64'})
+	if use_emissions_cache:
+		with run_metrics.stage('emissions_cache'):
+			if len(api_result_df.index) != 0:
+				store_cached_emissions(api_result_df, api_payload_columns, signatures)
+			api_result_df = pd.concat([api_result_df, cached_result_df],axis=0)
+	if use_row_collapsing:
+		with run_metrics.stage('merge'):
+			api_result_df = fan_out_emissions(api_result_df, row_payload_columns, payload_columns, group_codes)
 	
 	api_result_df['totalEmissions'] = api_result_df['mediaDistributionEmissions'] + api_result_df['adSelectionEmissions'] + api_result_df['creativeDistributionEmissions']
 	api_result_df = api_result_df[['identifier', 'domainCoverage', 'mediaDistributionEmissions', 'adSelectionEmissions', 'creativeDistributionEmissions', 'totalEmissions']]
+	return api_result_df, impressionsModeled, impressionsSkipped
 
-	print("All loops completed, now joining a few things together to compute key stats and create output CSV files for you...")
-	merged_df = report_df.merge(api_result_df, how='left', left_on='scope3_row_identifier', right_on='identifier')
-	total_campaign_impressions = merged_df[impressions_header].sum()
-	merged_df.to_csv(csv_file_name[:-4] + '_withScope3Emissions.csv', index=False)
+def merge_emissions(report_df, api_result_df):
+	# This function joins the API results back onto the input rows. The index keeps following the input file rows across chunks.
+	with run_metrics.stage('merge', len(report_df.index)):
+		merged_df = report_df.merge(api_result_df, how='left', left_on='scope3_row_identifier', right_on='identifier')
+		merged_df.index = report_df.index
+		return merged_df
+
+class OutputWriter:
+	# This class writes the output files of a run, as CSV and, when use_parquet_output is set, as Parquet next to them.
+	# Row level files can be written in several chunks: the first chunk creates the file and the next ones are appended to it.
+	def __init__(self):
+		if use_parquet_output and pyarrow is None:
+			raise ImportError("use_parquet_output is set to True but the pyarrow module isn't installed.")
+		self.written_files = set()
+		self.parquet_writers = {}
+
+	def append(self, df, file_name, index=True):
+		# file_name is given without extension, e.g. sample_input_withScope3Emissions.
+		first_chunk = file_name not in self.written_files
+		df.to_csv(file_name + '.csv', index=index, mode='w' if first_chunk else 'a', header=first_chunk)
+		self.written_files.add(file_name)
+		if use_parquet_output:
+			table = pyarrow.Table.from_pandas(df, preserve_index=index)
+			if first_chunk:
+				self.parquet_writers[file_name] = pyarrow.parquet.ParquetWriter(file_name + '.parquet', self.get_parquet_schema(table))
+			parquet_writer = self.parquet_writers[file_name]
+			parquet_writer.write_table(table.cast(parquet_writer.schema))
+
+	def get_parquet_schema(self, table):
+		# Returns the schema of a row level Parquet file, built from the table of its first chunk. Every chunk is cast to it, so it mustn't depend on the values of the first chunk:
+		# columns read or built as text (including categoricals that are empty in the first chunk) are stored as strings, integers as int64 and floats as float64.
+		text_columns = set(get_input_columns()[1] + ['scope3_formatted_date', 'scope3_formatted_device_type', 'scope3_formatted_creative_format', 'scope3_formatted_channel', 'domainCoverage'])
+		fields = []
+		for field in table.schema:
+			field_type = field.type.value_type if pyarrow.types.is_dictionary(field.type) else field.type
+			if field.name in text_columns or pyarrow.types.is_null(field_type):
+				field_type = pyarrow.large_string()
+			elif pyarrow.types.is_integer(field_type):
+				field_type = pyarrow.int64()
+			elif pyarrow.types.is_floating(field_type):
+				field_type = pyarrow.float64()
+			fields.append(pyarrow.field(field.name, field_type))
+		return pyarrow.schema(fields, metadata=table.schema.metadata)
 
+	def write_table(self, df, file_name, index=True, csv=True):
+		# Writes a whole breakdown table at once. csv=False only writes the Parquet file.
+		# Each table is timed as its own stage, named after the file without the input file prefix (e.g. report_emissions_top_domains).
+		with run_metrics.stage('report' + file_name[len(csv_file_name[:-4]):].replace('_scope3', ''), len(df.index)):
+			if csv:
+				df.to_csv(file_name + '.csv', index=index)
+			if use_parquet_output:
+				df.to_parquet(file_name + '.parquet', index=index)
+
+	def close(self):
+		for parquet_writer in self.parquet_writers.values():
+			parquet_writer.close()
+		self.parquet_writers = {}
+
+def get_domain_columns():
+	return [site_domain_or_app_header, separate_app_header] if use_separate_column_for_apps else [site_domain_or_app_header]
+
+def get_missed_domains(merged_df):
 	missedDomains_df = merged_df[merged_df.domainCoverage == 'missing']
-	missedDomains_df = missedDomains_df[[site_domain_or_app_header, separate_app_header, impressions_header]] if use_separate_column_for_apps else missedDomains_df[[site_domain_or_app_header, impressions_header]]
-	number_of_missed_domains = len(missedDomains_df.index)
-	merged_df = merged_df[merged_df.domainCoverage == 'modeled'] #Now Removing lines where we can't calculate emissions as we don't need them any more.
+	return missedDomains_df[get_domain_columns() + [impressions_header]]
+
+def aggregate_emissions(merged_df, impressionsModeled, impressionsSkipped):
+	# This function computes the partial totals and breakdowns of one merged dataframe (the whole file, or one chunk in streaming mode).
+	# The rows are only scanned once: they are grouped on every breakdown key at the same time (as categoricals), and all the totals and breakdowns are then derived from that much smaller grouped dataframe.
+	# Partial aggregates of several chunks are added together by combine_aggregates before reporting.
+	emissions_columns = ['totalEmissions', 'mediaDistributionEmissions', 'adSelectionEmissions', 'creativeDistributionEmissions']
+	domain_columns = get_domain_columns()
+	keys = [merged_df[column] if isinstance(merged_df[column].dtype, pd.CategoricalDtype) else merged_df[column].astype('category') for column in domain_columns + [device_type_header, creative_format_header, 'domainCoverage']]
+	grouped_df = merged_df.groupby(keys, observed=True, dropna=False, sort=False).agg(number_of_rows=(impressions_header, 'size'), **{column: (column, 'sum') for column in [impressions_header] + emissions_columns}).reset_index()
+
+	aggregates = {}
+	aggregates['total_campaign_impressions'] = grouped_df[impressions_header].sum()
+	aggregates['impressionsModeled'] = impressionsModeled
+	aggregates['impressionsSkipped'] = impressionsSkipped
+
+	missed_df = grouped_df[grouped_df.domainCoverage == 'missing']
+	aggregates['number_of_missed_domains'] = missed_df['number_of_rows'].sum()
+	aggregates['missed_by_domain'] = missed_df.groupby(domain_columns, dropna=not use_separate_column_for_apps, observed=True)[[impressions_header]].sum()
+
+	modeled_df = grouped_df[grouped_df.domainCoverage == 'modeled'] #Now Removing lines where we can't calculate emissions as we don't need them any more.
+	aggregates['emissions'] = modeled_df[emissions_columns].sum()
+	aggregates['by_domain'] = modeled_df.groupby(domain_columns, dropna=not use_separate_column_for_apps, observed=True)[[impressions_header, 'totalEmissions', 'mediaDistributionEmissions', 'adSelectionEmissions', 'creativeDistributionEmissions']].sum()
+	aggregates['by_device'] = modeled_df.groupby(device_type_header, observed=True)[[impressions_header, 'totalEmissions']].sum()
+	aggregates['by_format'] = modeled_df.groupby(creative_format_header, observed=True)[[impressions_header, 'totalEmissions']].sum()
+	return aggregates
+
+def combine_aggregates(aggregates_list):
+	# This function adds up the partial aggregates returned by aggregate_emissions for each chunk.
+	if len(aggregates_list) == 1:
+		return aggregates_list[0]
+	combined = {}
+	for key, first in aggregates_list[0].items():
+		if isinstance(first, pd.DataFrame):
+			grouped_df = pd.concat([aggregates[key] for aggregates in aggregates_list])
+			combined[key] = grouped_df.groupby(level=list(range(grouped_df.index.nlevels)), dropna=False, observed=True).sum()
+		else:
+			combined[key] = sum(aggregates[key] for aggregates in aggregates_list[1:]) + first
+	return combined
+
+def report_emissions(aggregates, output_writer):
+	# This function prints the key stats and breakdowns from the aggregates and exports the top domains CSV files.
+	# The key stats are also returned, to be gathered in the summary of run_jobs.
+	total_campaign_impressions = aggregates['total_campaign_impressions']
+	impressionsModeled = aggregates['impressionsModeled']
+	impressionsSkipped = aggregates['impressionsSkipped']
+	number_of_missed_domains = aggregates['number_of_missed_domains']
 	scope3_measurement_rate_pct = round(impressionsModeled*100 / total_campaign_impressions, 1)
-	total_emissions_in_grams = round(merged_df['totalEmissions'].sum(),2)
-	mediaDistributionEmissions_in_grams = round(merged_df['mediaDistributionEmissions'].sum(),2)
-	adSelectionEmissions_in_grams = round(merged_df['adSelectionEmissions'].sum(),2)
-	creativeDistributionEmissions_in_grams = round(merged_df['creativeDistributionEmissions'].sum(),2)
+	total_emissions_in_grams = round(aggregates['emissions']['totalEmissions'],2)
+	mediaDistributionEmissions_in_grams = round(aggregates['emissions']['mediaDistributionEmissions'],2)
+	adSelectionEmissions_in_grams = round(aggregates['emissions']['adSelectionEmissions'],2)
+	creativeDistributionEmissions_in_grams = round(aggregates['emissions']['creativeDistributionEmissions'],2)
 	avg_emissions_per_ad = round(total_emissions_in_grams / impressionsModeled,3)
 
 	print("==================")
@@ -287,11 +1244,10 @@ def evaluate_emissions(report_df):
 	print("adSelectionEmissions for the campaign: " + str(adSelectionEmissions_in_grams) + "g OR " + str(round(adSelectionEmissions_in_grams/1000000,5))+"mt." )
 	print("creativeDistributionEmissions for the campaign: " + str(creativeDistributionEmissions_in_grams) + "g OR " + str(round(creativeDistributionEmissions_in_grams/1000000,5))+"mt." )
 	print("Average CO2e emissions per impression: " + str(avg_emissions_per_ad) + "g." )
+	if use_emissions_cache:
+		print("Emissions cache: " + str(get_emissions_cache().hits) + " rows found in cache, " + str(get_emissions_cache().misses) + " rows sent to the API.")
 
-	if use_separate_column_for_apps:
-		groupedbyDomains_df = merged_df.groupby([site_domain_or_app_header, separate_app_header], dropna=False).aggregate({impressions_header:sum, 'totalEmissions':sum, 'mediaDistributionEmissions':sum, 'adSelectionEmissions':sum,'creativeDistributionEmissions':sum})
-	else:
-		groupedbyDomains_df = merged_df.groupby([site_domain_or_app_header]).aggregate({impressions_header:sum, 'totalEmissions':sum, 'mediaDistributionEmissions':sum, 'adSelectionEmissions':sum,'creativeDistributionEmissions':sum})
+	groupedbyDomains_df = aggregates['by_domain'].copy()
 	groupedbyDomains_df['avg_adSelectionEmissions_per_ad_in_grams'] = groupedbyDomains_df['adSelectionEmissions'] / groupedbyDomains_df[impressions_header]
 
 	print("==================")
@@ -300,44 +1256,243 @@ def evaluate_emissions(report_df):
 	print("We've just created " + csv_file_name[:-4] + "_withScope3Emissions.csv for you to download.")
 	print("Top 15 domains and apps ordered by impressions: ")
 	topDomainsByImps_df = groupedbyDomains_df.sort_values(impressions_header, ascending=False).head(15)
-	topDomainsByImps_df.to_csv(csv_file_name[:-4] + '_scope3_emissions_top_domains.csv')
+	output_writer.write_table(topDomainsByImps_df, csv_file_name[:-4] + '_scope3_emissions_top_domains')
 	print("We've created scope3_emissions_top_domains.csv.")
 	print("Top 15 most emitting domains and apps (having served more than 1000 imps) ")
 	topDomainsByEmissions_df = groupedbyDomains_df[groupedbyDomains_df[impressions_header]>1000].sort_values('avg_adSelectionEmissions_per_ad_in_grams', ascending=False).head(15)
-	topDomainsByEmissions_df.to_csv(csv_file_name[:-4] + '_scope3_emissions_most_emitting_domains.csv')
+	output_writer.write_table(topDomainsByEmissions_df, csv_file_name[:-4] + '_scope3_emissions_most_emitting_domains')
 	print("We've created "+ csv_file_name[:-4] + "_scope3_emissions_most_emitting_domains.csv for you to download.")
 
 	print("==================")
 	print("DISPLAYING SOME USEFUL BREAKDOWNS: ")
 	print("Breakdwon by DEVICE")
-	groupedbyDevice_df = merged_df.groupby(device_type_header, as_index=False).aggregate({impressions_header:sum, 'totalEmissions':sum})
+	groupedbyDevice_df = aggregates['by_device'].reset_index()
 	groupedbyDevice_df['avg_emissions_per_ad_in_grams'] = groupedbyDevice_df['totalEmissions']/groupedbyDevice_df[impressions_header]
-	#groupedbyDevice_df.to_csv(csv_file_name[:-4] + '_scope3_emissions_by_device_type.csv', index=False) #Remove the comment sign if you wish to also create a CSV output.
+	output_writer.write_table(groupedbyDevice_df, csv_file_name[:-4] + '_scope3_emissions_by_device_type', index=False, csv=False) #Set csv to True if you wish to also create a CSV output.
 	print(groupedbyDevice_df)
 
 	print("\n")
 	print("Breakdwon by FORMAT")
-	groupedbyFormat_df = merged_df.groupby(creative_format_header, as_index=False).aggregate({impressions_header:sum, 'totalEmissions':sum})
+	groupedbyFormat_df = aggregates['by_format'].reset_index()
 	groupedbyFormat_df['avg_emissions_per_ad_in_grams'] = groupedbyFormat_df['totalEmissions']/groupedbyFormat_df[impressions_header]
-	#groupedbyFormat_df.to_csv(csv_file_name[:-4] + '_scope3_emissions_by_format_type.csv') #Remove the comment sign if you wish to also create a CSV output.
+	output_writer.write_table(groupedbyFormat_df, csv_file_name[:-4] + '_scope3_emissions_by_format_type', csv=False) #Set csv to True if you wish to also create a CSV output.
 	print(groupedbyFormat_df)
 
 	if number_of_missed_domains != 0:
-		if use_separate_column_for_apps:
-			top10MissedDomains_df = missedDomains_df.groupby([site_domain_or_app_header, separate_app_header], dropna=False, as_index=False).aggregate({impressions_header:sum}).sort_values(impressions_header, ascending=False).head(10)
-		else:
-			top10MissedDomains_df = missedDomains_df.groupby(site_domain_or_app_header, as_index=False).aggregate({impressions_header:sum}).sort_values(impressions_header, ascending=False).head(10)
-		missedDomains_df.to_csv(csv_file_name[:-4] + '_scope3_missing_domains.csv')
+		top10MissedDomains_df = aggregates['missed_by_domain'].reset_index().sort_values(impressions_header, ascending=False).head(10)
 		print("\n")
 		print("Domains and apps that weren't modeled:")
 		print("We've created "+ csv_file_name[:-4] + "_scope3_missing_domains.csv. These are the top 10 domains that are missing:")
 		print(top10MissedDomains_df)
 
-print("==================")
-print("START OF SCRIPT")
-print("==================")
-evaluate_emissions(prepare_input_file(csv_file_name))
-print("==================")
-print("END OF SCRIPT")
-print("==================")
-print("Need help understanding this script or have feedback? Reach out to your Scope3 representative or contact support[AT]scope3.com")
+	return {
+		'total_campaign_impressions': int(total_campaign_impressions),
+		'impressionsModeled': int(impressionsModeled),
+		'impressionsSkipped': int(impressionsSkipped),
+		'measurement_rate_pct': float(scope3_measurement_rate_pct),
+		'number_of_missed_domains': int(number_of_missed_domains),
+		'totalEmissions': float(total_emissions_in_grams),
+		'mediaDistributionEmissions': float(mediaDistributionEmissions_in_grams),
+		'adSelectionEmissions': float(adSelectionEmissions_in_grams),
+		'creativeDistributionEmissions': float(creativeDistributionEmissions_in_grams),
+		'avg_emissions_per_impression': float(avg_emissions_per_ad),
+	}
+
+def write_merged_outputs(merged_df, output_writer):
+	# This function writes (or appends, in streaming mode) the rows of the merged dataframe to the _withScope3Emissions and _scope3_missing_domains output files.
+	with run_metrics.stage('write_outputs', len(merged_df.index)):
+		output_writer.append(merged_df, csv_file_name[:-4] + '_withScope3Emissions', index=False)
+		missedDomains_df = get_missed_domains(merged_df)
+		if len(missedDomains_df.index) != 0:
+			output_writer.append(missedDomains_df, csv_file_name[:-4] + '_scope3_missing_domains')
+
+def evaluate_emissions(report_df):
+	# This function uses the dataframe constructed in the previous function to build JSON objects and make the necessary number of calls to the Scope3 API to obtain emissions data.
+	# Key stats are calculated off the back of this data and displayed on terminal through prints, as well as exported as CSV files. They are returned as a dict.
+	api_result_df, impressionsModeled, impressionsSkipped = fetch_emissions(report_df, ProgressLine())
+
+	print("All loops completed, now joining a few things together to compute key stats and create output CSV files for you...")
+	merged_df = merge_emissions(report_df, api_result_df)
+	output_writer = OutputWriter()
+	write_merged_outputs(merged_df, output_writer)
+
+	with run_metrics.stage('aggregate', len(merged_df.index)):
+		aggregates = aggregate_emissions(merged_df, impressionsModeled, impressionsSkipped)
+	with run_metrics.stage('report'):
+		key_stats = report_emissions(aggregates, output_writer)
+		output_writer.close()
+	if use_checkpoints:
+		remove_checkpoints()
+	return key_stats
+
+def evaluate_emissions_streaming(csv_file):
+	# This function is the streaming counterpart of evaluate_emissions(prepare_input_file(csv_file)).
+	# Each chunk of the input file is formatted, sent to the API, merged and appended to the output CSV files before the next chunk is read.
+	# Only the partial aggregates of each chunk are kept in memory to compute the key stats at the end.
+	for extension in ['.csv', '.parquet']:
+		if os.path.exists(csv_file_name[:-4] + '_scope3_missing_domains' + extension):
+			os.remove(csv_file_name[:-4] + '_scope3_missing_domains' + extension)
+	output_writer = OutputWriter()
+	aggregates_list = []
+	number_of_rows = 0
+	# A single progress line covers all the chunks, so its rows/s and estimated time left are those of the whole file.
+	progress = ProgressLine()
+
+	for chunk_number, report_df in enumerate(read_input_file_in_chunks(csv_file, progress)):
+		number_of_rows += len(report_df.index)
+		print("Processing chunk number " + str(chunk_number+1) + " (" + str(number_of_rows) + " rows read so far)...")
+		api_result_df, impressionsModeled, impressionsSkipped = fetch_emissions(report_df, progress)
+		merged_df = merge_emissions(report_df, api_result_df)
+		write_merged_outputs(merged_df, output_writer)
+		with run_metrics.stage('aggregate', len(merged_df.index)):
+			aggregates_list.append(aggregate_emissions(merged_df, impressionsModeled, impressionsSkipped))
+			# Folding the partial aggregates as we go keeps their memory bounded by the number of distinct domains, not by the number of chunks.
+			aggregates_list = [combine_aggregates(aggregates_list)]
+
+	print("Number of valid rows found: " + str(number_of_rows) + " rows")
+	print("All chunks completed, now computing key stats and creating output CSV files for you...")
+	with run_metrics.stage('report'):
+		key_stats = report_emissions(aggregates_list[0], output_writer)
+		output_writer.close()
+	if use_checkpoints:
+		remove_checkpoints()
+	return key_stats
+
+############################## SEVERAL INPUT FILES #########################################
+def init_worker(normalized_entries, next_request_slot, request_slots):
+	# Runs once in each worker process of run_jobs: the worker starts from the normalized domains and apps already known to the parent process,
+	# and shares the rate limiter and the concurrent requests semaphore of all the workers.
+	global shared_next_request_slot, shared_request_slots
+	normalization_cache.add_entries(normalized_entries)
+	normalization_cache.track_new_keys = True
+	shared_next_request_slot = next_request_slot
+	shared_request_slots = request_slots
+
+def run_job(config):
+	# This function processes one input file with its own config (a dict of settings from the CONFIG section, including csv_file_name) and returns its key stats and run metrics.
+	# It is run in a worker process by run_jobs: the prints of the run go to a log file named after the input file, e.g. client_a_scope3_log.txt.
+	global run_metrics, emissions_cache
+	apply_config(config)
+	run_metrics = RunMetrics()
+	if emissions_cache is not None:
+		emissions_cache.connection.close()
+		emissions_cache = None
+	with open(csv_file_name[:-4] + '_scope3_log.txt', 'w') as log_file, contextlib.redirect_stdout(log_file):
+		try:
+			if use_streaming_mode:
+				key_stats = evaluate_emissions_streaming(csv_file_name)
+			else:
+				key_stats = evaluate_emissions(prepare_input_file(csv_file_name))
+			run_metrics.report()
+		except Exception:
+			traceback.print_exc(file=log_file)
+			raise
+	# The domains and apps normalized for this file are sent back to the parent process, which merges them into its own normalization cache.
+	return {'key_stats': key_stats, 'metrics': run_metrics.get_summary(), 'normalized_entries': normalization_cache.pop_new_entries()}
+
+def get_file_size(file_name):
+	return os.path.getsize(file_name) if os.path.exists(file_name) else 0
+
+def summarize_jobs(results):
+	# This function builds the consolidated summary of run_jobs: one row per input file, plus a TOTAL row across all the files that completed.
+	summary_rows = []
+	for file_name, result in results:
+		summary_row = {'input_file': file_name, 'status': 'failed' if 'error' in result else 'completed'}
+		if 'error' not in result:
+			summary_row['rows'] = result['metrics']['stages']['read']['rows']
+			summary_row.update(result['key_stats'])
+			summary_row['seconds'] = result['metrics']['seconds']
+			summary_row['api_calls'] = result['metrics']['api']['calls']
+			summary_row['retries'] = result['metrics']['api']['retries']
+		summary_row['error'] = result.get('error', '')
+		summary_rows.append(summary_row)
+	summary_df = pd.DataFrame(summary_rows)
+
+	completed_df = summary_df[summary_df.status == 'completed']
+	if len(completed_df.index) != 0:
+		total_row = completed_df.drop(columns=['input_file', 'status', 'error']).sum().to_dict()
+		total_row['measurement_rate_pct'] = round(total_row['impressionsModeled']*100 / total_row['total_campaign_impressions'], 1)
+		total_row['avg_emissions_per_impression'] = round(total_row['totalEmissions'] / total_row['impressionsModeled'], 3)
+		summary_df = pd.concat([summary_df, pd.DataFrame([dict(total_row, input_file='TOTAL', status=str(len(completed_df.index)) + '/' + str(len(summary_df.index)) + ' completed', error='')])], ignore_index=True)
+	return summary_df
+
+def run_jobs(jobs, max_workers=None, summary_file='scope3_summary.csv'):
+	# This function processes several input files in parallel, one per worker process, each with its own config (see run_job). Every file gets its own output files.
+	# Files are started from the largest to the smallest, so that a large file started last doesn't hold up the end of the run.
+	# Workers start from the normalization cache of this process, and the domains and apps they normalize are merged back into it (and saved to normalization_cache_file when it is set).
+	# max_requests_per_second and max_concurrent_requests (as set in this process, e.g. with --config) apply to all the workers together, not to each of them.
+	# A file that fails doesn't stop the others. The consolidated summary is written to summary_file and returned as a dataframe.
+	jobs = sorted(jobs, key=lambda job: get_file_size(job['csv_file_name']), reverse=True)
+	normalization_cache.load(normalization_cache_file)
+	print("Processing " + str(len(jobs)) + " input file(s) with " + str(min(max_workers or os.cpu_count(), len(jobs))) + " worker process(es), largest files first.")
+
+	results = []
+	all_metrics = {}
+	next_request_slot = multiprocessing.Value('d', time.monotonic())
+	request_slots = multiprocessing.BoundedSemaphore(max(1, max_concurrent_requests))
+	with ProcessPoolExecutor(max_workers=min(max_workers or os.cpu_count(), len(jobs)), initializer=init_worker, initargs=(list(normalization_cache.entries.items()), next_request_slot, request_slots)) as executor:
+		futures = {executor.submit(run_job, job): job['csv_file_name'] for job in jobs}
+		for number_of_files_done, future in enumerate(as_completed(futures), start=1):
+			file_name = futures[future]
+			try:
+				result = future.result()
+				normalization_cache.add_entries(result.pop('normalized_entries'))
+				all_metrics[file_name] = result['metrics']
+				print("Completed " + file_name + " (" + str(number_of_files_done) + "/" + str(len(jobs)) + ") in " + str(result['metrics']['seconds']) + "s: " + str(result['key_stats']['totalEmissions']) + "g for " + str(result['key_stats']['total_campaign_impressions']) + " imps.")
+			except Exception as error:
+				result = {'error': repr(error)}
+				print("FAILED " + file_name + " (" + str(number_of_files_done) + "/" + str(len(jobs)) + "): " + repr(error) + ". See " + file_name[:-4] + "_scope3_log.txt for details.")
+			results.append((file_name, result))
+	normalization_cache.save(normalization_cache_file)
+
+	summary_df = summarize_jobs(results)
+	summary_df.to_csv(summary_file, index=False)
+	print("==================")
+	print("SUMMARY ACROSS ALL INPUT FILES: ")
+	print(summary_df.drop(columns=['error']))
+	print("We've created " + summary_file + " for you to download.")
+	if metrics_file:
+		with open(metrics_file, 'w') as metrics:
+			json.dump(all_metrics, metrics, indent=2)
+		print("We've saved the run metrics of every file in " + metrics_file + ".")
+	return summary_df
+
+def main():
+	parser = argparse.ArgumentParser(description="Fetches Scope3 emissions for one or several CSV input files. Without input files or jobs, csv_file_name from the CONFIG section is processed.")
+	parser.add_argument('input_files', nargs='*', help="CSV input files, processed in parallel with the same config.")
+	parser.add_argument('--config', help="JSON file of settings from the CONFIG section applied to every input file, e.g. {\"date_format\": \"%%Y-%%m-%%d\", \"AccessClientId\": \"...\"}.")
+	parser.add_argument('--jobs', help="JSON file with a list of configs, one per input file or client, each with its own csv_file_name. They are applied on top of --config.")
+	parser.add_argument('--workers', type=int, default=os.cpu_count(), help="Number of input files processed at the same time. max_requests_per_second and max_concurrent_requests are shared by all the workers.")
+	parser.add_argument('--summary-file', default='scope3_summary.csv', help="Consolidated summary across all input files.")
+	args = parser.parse_args()
+
+	config = {}
+	if args.config:
+		with open(args.config) as config_file:
+			config = json.load(config_file)
+	apply_config(config)
+	jobs = [dict(config, csv_file_name=input_file) for input_file in args.input_files]
+	if args.jobs:
+		with open(args.jobs) as jobs_file:
+			jobs += [dict(config, **job) for job in json.load(jobs_file)]
+
+	print("==================")
+	print("START OF SCRIPT")
+	print("==================")
+	if jobs:
+		run_jobs(jobs, args.workers, args.summary_file)
+	else:
+		normalization_cache.load(normalization_cache_file)
+		if use_streaming_mode:
+			evaluate_emissions_streaming(csv_file_name)
+		else:
+			evaluate_emissions(prepare_input_file(csv_file_name))
+		normalization_cache.save(normalization_cache_file)
+		run_metrics.report(metrics_file)
+	print("==================")
+	print("END OF SCRIPT")
+	print("==================")
+	print("Need help understanding this script or have feedback? Reach out to your Scope3 representative or contact support[AT]scope3.com")
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,41 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark_scope3_api_script as benchmark
+import sample_scope3_api_script as scope3
+
+
+@pytest.fixture
+def mock_api():
+	# Local mock of the Scope3 API (see benchmark_scope3_api_script.py), yields the url to post to.
+	server = benchmark.start_mock_api()
+	yield 'http://127.0.0.1:' + str(server.server_port) + '/v1/calculate/daily?includeRows=true&previewMethodology=false'
+	server.shutdown()
+	server.server_close()
+
+
+@pytest.fixture
+def run_in(tmp_path, monkeypatch, mock_api):
+	# Runs the tests in a temporary directory against the mock API, with quick re-tries.
+	# The settings changed by a test go back to their defaults afterwards.
+	monkeypatch.chdir(tmp_path)
+	scope3.apply_config({'url': mock_api, 'retry_base_delay_seconds': 0.01})
+	scope3.run_metrics = scope3.RunMetrics()
+	yield tmp_path
+	if scope3.emissions_cache is not None:
+		scope3.emissions_cache.connection.close()
+		scope3.emissions_cache = None
+	scope3.apply_config({})
+	scope3.run_metrics = scope3.RunMetrics()
+
+
+def run_script(csv_file, **config):
+	# Runs the script on csv_file with the given settings on top of the ones of the run_in fixture, and returns its key stats.
+	scope3.apply_config(dict({'url': scope3.url, 'retry_base_delay_seconds': 0.01, 'csv_file_name': csv_file}, **config))
+	if scope3.use_streaming_mode:
+		return scope3.evaluate_emissions_streaming(csv_file)
+	return scope3.evaluate_emissions(scope3.prepare_input_file(csv_file))
@@ -0,0 +1,40 @@
+import os
+
+import pytest
+import requests
+
+import benchmark_scope3_api_script as benchmark
+import sample_scope3_api_script as scope3
+from conftest import run_script
+
+
+def test_rerun_only_sends_the_batches_that_failed(run_in, monkeypatch):
+	benchmark.generate_input_file('input.csv', 2000, number_of_domains=50, number_of_apps=20)
+	settings = {'use_checkpoints': True, 'max_json_rows': 200, 'max_concurrent_requests': 1}
+	clean_key_stats = run_script('input.csv', max_json_rows=200)
+
+	# The 4th call of the next run is rejected, so the run stops before sending all of its 10 batches.
+	do_POST = benchmark.MockScope3API.do_POST
+	calls = []
+	def do_POST_failing_fourth_call(self):
+		calls.append(self.path)
+		if len(calls) == 4:
+			benchmark.MockScope3API.forced_errors = [(400, {})]
+		do_POST(self)
+	monkeypatch.setattr(benchmark.MockScope3API, 'do_POST', do_POST_failing_fourth_call)
+	with pytest.raises(requests.exceptions.HTTPError):
+		run_script('input.csv', **settings)
+	number_of_checkpoints = len(os.listdir('input_scope3_checkpoints'))
+	assert 3 <= number_of_checkpoints < 10
+
+	scope3.run_metrics = scope3.RunMetrics()
+	key_stats = run_script('input.csv', **settings)
+	api = scope3.run_metrics.get_summary()['api']
+	assert (api['batches_from_checkpoints'], api['batches']) == (number_of_checkpoints, 10 - number_of_checkpoints)
+	assert key_stats == {key: pytest.approx(value) for key, value in clean_key_stats.items()}
+
+	# Once the run has completed, its checkpoints are gone and the next run calls the API again.
+	assert not os.path.exists('input_scope3_checkpoints')
+	scope3.run_metrics = scope3.RunMetrics()
+	run_script('input.csv', **settings)
+	assert scope3.run_metrics.get_summary()['api']['batches'] == 10
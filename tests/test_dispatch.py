@@ -0,0 +1,91 @@
+import time
+
+import pytest
+import requests
+
+import benchmark_scope3_api_script as benchmark
+import sample_scope3_api_script as scope3
+from conftest import run_script
+
+
+def build_report(rows):
+	benchmark.generate_input_file('input.csv', rows, number_of_domains=50, number_of_apps=20)
+	return scope3.prepare_input_file('input.csv')
+
+
+def test_batches_are_reassembled_in_order(run_in, monkeypatch):
+	# 1050 rows in batches of 100: the last batch is partial, and the first batches are answered last.
+	calculate = benchmark.MockScope3API.calculate
+	def calculate_first_batches_last(self, rows):
+		time.sleep(0.2 if int(rows[0]['identifier']) < 300 else 0)
+		return calculate(self, rows)
+	monkeypatch.setattr(benchmark.MockScope3API, 'calculate', calculate_first_batches_last)
+	scope3.apply_config({'url': scope3.url, 'max_json_rows': 100, 'max_concurrent_requests': 4})
+	report_df = build_report(1050)
+
+	api_result_df, impressionsModeled, impressionsSkipped = scope3.fetch_emissions(report_df)
+
+	assert api_result_df['identifier'].tolist() == list(range(1050))
+	assert impressionsModeled + impressionsSkipped == report_df['Impressions'].sum()
+	assert [batch['rows'] for batch in scope3.run_metrics.get_summary()['batch_details']] == [100] * 10 + [50]
+
+
+def test_retries_follow_retry_after_and_backoff(run_in):
+	# A long base delay shows the Retry-After of the 429 is used instead, the 503 without it falls back to the backoff.
+	scope3.apply_config({'url': scope3.url, 'max_json_rows': 500, 'max_concurrent_requests': 1, 'retry_base_delay_seconds': 0.05})
+	benchmark.MockScope3API.forced_errors = [(429, {'Retry-After': '0.3'}), (503, {})]
+	report_df = build_report(200)
+
+	start_time = time.monotonic()
+	api_result_df = scope3.fetch_emissions(report_df)[0]
+
+	assert 0.3 <= time.monotonic() - start_time < 2
+	assert len(api_result_df.index) == 200
+	api = scope3.run_metrics.get_summary()['api']
+	assert api['retries'] == 2
+	assert api['http_status_counts'] == {'429': 1, '503': 1, '200': 1}
+
+
+def test_batch_fails_after_max_retries(run_in):
+	scope3.apply_config({'url': scope3.url, 'max_retries': 2, 'retry_base_delay_seconds': 0.01})
+	benchmark.MockScope3API.forced_errors = [(503, {})] * 3
+	with pytest.raises(requests.exceptions.HTTPError):
+		scope3.fetch_emissions(build_report(10))
+	assert scope3.run_metrics.get_summary()['api']['http_status_counts'] == {'503': 3}
+
+
+def test_client_errors_are_not_retried(run_in):
+	benchmark.MockScope3API.forced_errors = [(400, {})]
+	with pytest.raises(requests.exceptions.HTTPError):
+		scope3.fetch_emissions(build_report(10))
+	assert scope3.run_metrics.get_summary()['api']['http_status_counts'] == {'400': 1}
+
+
+def test_retry_delay(monkeypatch):
+	monkeypatch.setattr(scope3, 'retry_base_delay_seconds', 2)
+	monkeypatch.setattr(scope3, 'retry_max_delay_seconds', 60)
+	assert all(0 <= scope3.get_retry_delay(3) <= 16 for _ in range(100))
+	assert all(0 <= scope3.get_retry_delay(10) <= 60 for _ in range(100))
+	assert scope3.get_retry_delay(0, '5') == 5
+	assert scope3.get_retry_delay(0, '600') == 60
+	assert 0 <= scope3.get_retry_delay(0, 'Wed, 21 Oct 2015 07:28:00 GMT') <= 2
+
+
+def test_failed_batch_cancels_the_batches_not_sent_yet(run_in):
+	# 100 batches, 2 at a time: once batch 1 is rejected, only the batches already in flight may still reach the API.
+	benchmark.MockScope3API.latency = 0.05
+	scope3.apply_config({'url': scope3.url, 'max_json_rows': 20, 'max_concurrent_requests': 2})
+	benchmark.MockScope3API.forced_errors = [(400, {})]
+	with pytest.raises(requests.exceptions.HTTPError):
+		scope3.fetch_emissions(build_report(2000))
+	http_status_counts = scope3.run_metrics.get_summary()['api']['http_status_counts']
+	assert http_status_counts['400'] == 1
+	assert sum(http_status_counts.values()) <= 4
+
+
+def test_progress_covers_all_the_chunks_of_a_streaming_run(run_in, capsys):
+	benchmark.generate_input_file('input.csv', 5000, number_of_domains=50, number_of_apps=20)
+	run_script('input.csv', use_streaming_mode=True, streaming_chunk_rows=1000, max_json_rows=500, show_progress=True)
+	progress_lines = [line for line in capsys.readouterr().out.splitlines() if line.startswith('Progress: ')]
+	assert [line.split(' ')[1].split('/')[0] for line in progress_lines] == [str(rows) for rows in range(500, 5001, 500)]
+	assert progress_lines[-1].startswith('Progress: 5000/5000 rows (100.0%)')
@@ -0,0 +1,29 @@
+import pandas as pd
+import pytest
+
+import benchmark_scope3_api_script as benchmark
+import sample_scope3_api_script as scope3
+from conftest import run_script
+
+
+def test_cached_rows_are_not_sent_again(run_in):
+	benchmark.generate_input_file('input.csv', 2000, number_of_domains=50, number_of_apps=20)
+	settings = {'use_emissions_cache': True, 'emissions_cache_file': 'cache.sqlite', 'max_json_rows': 500}
+
+	first_key_stats = run_script('input.csv', **settings)
+	first_df = pd.read_csv('input_withScope3Emissions.csv')
+	assert (scope3.get_emissions_cache().hits, scope3.get_emissions_cache().misses) == (0, 2000)
+
+	scope3.emissions_cache.connection.close()
+	scope3.emissions_cache = None
+	second_key_stats = run_script('input.csv', **settings)
+	assert (scope3.get_emissions_cache().hits, scope3.get_emissions_cache().misses) == (2000, 0)
+	pd.testing.assert_frame_equal(pd.read_csv('input_withScope3Emissions.csv'), first_df, check_exact=False)
+	assert second_key_stats == {key: pytest.approx(value) for key, value in first_key_stats.items()}
+
+	# Results cached for one endpoint aren't re-used for another one.
+	scope3.emissions_cache.connection.close()
+	scope3.emissions_cache = None
+	run_script('input.csv', url=scope3.url + '&other=1', **settings)
+	assert scope3.get_emissions_cache().hits == 0
+
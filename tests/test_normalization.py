@@ -0,0 +1,15 @@
+import sample_scope3_api_script as scope3
+
+
+def test_normalization_cache_only_tracks_new_keys_in_workers():
+	cache = scope3.NormalizationCache(3)
+	for number in range(10):
+		cache.normalize('domain', 'https://www.site' + str(number) + '.com/page')
+	assert len(cache.entries) == 3
+	assert len(cache.new_keys) == 0
+
+	cache.track_new_keys = True
+	for number in range(10, 20):
+		cache.normalize('domain', 'https://www.site' + str(number) + '.com/page')
+	assert cache.pop_new_entries() == [(('domain', 'https://www.site' + str(number) + '.com/page'), 'site' + str(number) + '.com') for number in range(17, 20)]
+	assert len(cache.new_keys) == 0
@@ -0,0 +1,26 @@
+import pandas as pd
+
+import benchmark_scope3_api_script as benchmark
+from conftest import run_script
+
+
+def test_streaming_parquet_output_with_chunks_of_different_types(run_in):
+	# The first chunk has small impressions, no seller and no buying method; the next ones need wider types and have text in those columns.
+	benchmark.generate_input_file('input.csv', 3000, number_of_domains=50, number_of_apps=20)
+	input_df = pd.read_csv('input.csv')
+	input_df.loc[:999, 'Impressions'] = input_df.loc[:999, 'Impressions'] % 100
+	input_df.loc[:999, ['Seller', 'Buying Method']] = None
+	input_df.loc[2500, 'Impressions'] = 2**33
+	input_df.to_csv('input.csv', index=False)
+
+	key_stats = run_script('input.csv', use_streaming_mode=True, streaming_chunk_rows=1000, use_parquet_output=True)
+
+	parquet_df = pd.read_parquet('input_withScope3Emissions.parquet')
+	csv_df = pd.read_csv('input_withScope3Emissions.csv')
+	assert len(parquet_df.index) == len(csv_df.index) == 3000
+	assert parquet_df['Impressions'].tolist() == input_df['Impressions'].tolist()
+	assert parquet_df['Seller'].iloc[:1000].isna().all()
+	assert parquet_df['Seller'].iloc[1000:].tolist() == csv_df['Seller'].iloc[1000:].tolist()
+	assert parquet_df['totalEmissions'].sum() == csv_df['totalEmissions'].sum()
+	assert len(pd.read_parquet('input_scope3_missing_domains.parquet').index) == len(pd.read_csv('input_scope3_missing_domains.csv').index)
+	assert key_stats['total_campaign_impressions'] == input_df['Impressions'].sum()
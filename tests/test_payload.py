@@ -0,0 +1,59 @@
+import pandas as pd
+import pytest
+
+import benchmark_scope3_api_script as benchmark
+import sample_scope3_api_script as scope3
+
+
+def build_reference_rows(report_df):
+	# The API rows as the script used to build them, one row at a time with iterrows.
+	rows = []
+	for index, row in report_df.iterrows():
+		row_dict = {}
+		row_dict["identifier"] = str(row["scope3_row_identifier"])
+		if row["scope3_formatted_channel"] != '':
+			row_dict["channel"] = str(row["scope3_formatted_channel"])
+		if row["scope3_formatted_channel"] in ['display-web']:
+			row_dict["inventoryId"] = scope3.normalizeDomain(str(row[scope3.site_domain_or_app_header]))
+		elif row["scope3_formatted_channel"] in ['display-app', '', 'streaming-video']:
+			row_dict["inventoryId"] = scope3.normalizeApp(str(row[scope3.site_domain_or_app_header]))
+		row_dict["country"] = row[scope3.country_header]
+		row_dict["deviceType"] = row["scope3_formatted_device_type"]
+		try:
+			row_dict["impressions"] = int(row[scope3.impressions_header])
+		except ValueError:
+			row_dict["impressions"] = 0
+		row_dict["date"] = str(row["scope3_formatted_date"])
+		row_dict["creative"] = {"format": row['scope3_formatted_creative_format']}
+		if row["scope3_formatted_creative_format"] == 'video':
+			row_dict["creative"]["durationSeconds"] = int(row[scope3.creative_duration_header])
+		elif row["scope3_formatted_creative_format"] == 'banner':
+			row_dict["creative"]['payloadSize'] = int(int(row['scope3_formatted_width']) * int(row['scope3_formatted_height']) * 1.2)
+		if not scope3.isNaN(row[scope3.seller_header]):
+			row_dict["seller"] = str(row[scope3.seller_header])
+		if row[scope3.buyingMethod_header] in scope3.supported_buyingMethods:
+			row_dict["buyingMethod"] = row[scope3.buyingMethod_header]
+		rows.append(row_dict)
+	return rows
+
+
+@pytest.mark.parametrize('use_streaming_mode', [False, True])
+def test_payload_rows_match_row_by_row_build(run_in, use_streaming_mode):
+	benchmark.generate_input_file('input.csv', 2000, number_of_domains=200, number_of_apps=100)
+	input_df = pd.read_csv('input.csv')
+	input_df.loc[::7, 'Environment'] = 'Unknown channel'
+	input_df.loc[::11, 'Creative Size'] = 'Unknown'
+	input_df.to_csv('input.csv', index=False)
+	scope3.apply_config({'url': scope3.url, 'streaming_chunk_rows': 300})
+
+	report_dfs = list(scope3.read_input_file_in_chunks('input.csv')) if use_streaming_mode else [scope3.prepare_input_file('input.csv')]
+	for report_df in report_dfs:
+		payload_columns = scope3.build_payload_columns(report_df)
+		reference_rows = build_reference_rows(report_df)
+		# Batches are built by slices, which must cover every row exactly once.
+		rows = []
+		for start in range(0, len(report_df.index), 128):
+			rows += scope3.build_payload_rows(payload_columns, start, start + 128)
+		assert rows == reference_rows
+		assert scope3.decode_json(scope3.encode_request_body({"rows": rows})) == {"rows": reference_rows}
+	assert sum(len(report_df.index) for report_df in report_dfs) == 2000
@@ -0,0 +1,36 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import benchmark_scope3_api_script as benchmark
+import sample_scope3_api_script as scope3
+from conftest import run_script
+
+
+@pytest.mark.parametrize('use_streaming_mode', [False, True])
+def test_collapsed_rows_get_the_same_emissions(run_in, use_streaming_mode):
+	# Every row is repeated with other line item IDs and impressions, and the first 50 rows have no impressions in any of their copies.
+	benchmark.generate_input_file('input.csv', 500, number_of_domains=50, number_of_apps=20)
+	input_df = pd.read_csv('input.csv')
+	input_df.loc[:49, 'Impressions'] = 0
+	copies = []
+	for copy_number in range(3):
+		copy_df = input_df.copy()
+		copy_df['Line Item ID'] = copy_df['Line Item ID'] + 1000 * copy_number
+		copy_df.loc[50:, 'Impressions'] = np.random.default_rng(copy_number).integers(1, 5000, len(copy_df.index) - 50)
+		copies.append(copy_df)
+	pd.concat(copies).sample(frac=1, random_state=0).to_csv('input.csv', index=False)
+	settings = {'use_streaming_mode': use_streaming_mode, 'streaming_chunk_rows': 400, 'max_json_rows': 100}
+
+	key_stats = run_script('input.csv', **settings)
+	output_df = pd.read_csv('input_withScope3Emissions.csv')
+	assert (output_df['Impressions'] == 0).sum() == 150
+	api_rows = scope3.run_metrics.get_summary()['api']['rows']
+	assert api_rows == 1500
+
+	scope3.run_metrics = scope3.RunMetrics()
+	collapsed_key_stats = run_script('input.csv', use_row_collapsing=True, **settings)
+	collapsed_output_df = pd.read_csv('input_withScope3Emissions.csv')
+	assert scope3.run_metrics.get_summary()['api']['rows'] < api_rows
+	pd.testing.assert_frame_equal(collapsed_output_df, output_df, check_exact=False)
+	assert collapsed_key_stats == {key: pytest.approx(value) for key, value in key_stats.items()}
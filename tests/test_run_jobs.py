@@ -0,0 +1,25 @@
+import time
+
+import pandas as pd
+
+import benchmark_scope3_api_script as benchmark
+import sample_scope3_api_script as scope3
+
+
+def test_run_jobs_shares_api_limits_between_workers(run_in):
+	# 3 files of 3 to 4 batches, processed by 3 workers: the limits must hold for the 11 calls together.
+	benchmark.MockScope3API.latency = 0.05
+	jobs = []
+	for number in range(3):
+		benchmark.generate_input_file('input_' + str(number) + '.csv', 400 + 100 * number, number_of_domains=50, number_of_apps=20, seed=number)
+		jobs.append({'csv_file_name': 'input_' + str(number) + '.csv', 'url': scope3.url, 'max_json_rows': 150})
+	scope3.apply_config({'url': scope3.url, 'max_concurrent_requests': 2, 'max_requests_per_second': 20})
+
+	start_time = time.monotonic()
+	summary_df = scope3.run_jobs(jobs, max_workers=3, summary_file='summary.csv')
+
+	assert benchmark.MockScope3API.max_calls_in_flight <= 2
+	assert time.monotonic() - start_time >= 10 / 20
+	assert (summary_df['status'][:3] == 'completed').all()
+	assert summary_df['api_calls'][:3].sum() == 11
+	assert pd.read_csv('summary.csv')['rows'].iloc[-1] == 400 + 500 + 600